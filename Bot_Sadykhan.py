@@ -1,60 +1,210 @@
+import argparse
+import atexit
 import logging
 import os
+import re
+import signal
+import sys
+import tempfile
 import csv
+import ctypes
+import hashlib
 import pytz
 import time
 from datetime import datetime
 from dotenv import load_dotenv
-import pandas as pd
-from openpyxl import load_workbook
+from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Font
 import asyncio
+import bisect
+import collections
+import dataclasses
+import functools
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+import io
 import json
-from logging.handlers import RotatingFileHandler
-import aiofiles
+import multiprocessing
+import pickle
+import queue
+import random
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-from aiogram import Bot, Dispatcher, F, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
 from aiogram.enums import ParseMode
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import FSInputFile, Update
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.types import BufferedInputFile, FSInputFile, Update
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, SendDocument
 from aiohttp import web
 
 # === Настройка логирования ===
+load_dotenv()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+LOG_DUMP_SAMPLE_RATE = float(os.getenv("LOG_DUMP_SAMPLE_RATE", 1.0))
+LOG_DUMP_BUDGET = int(os.getenv("LOG_DUMP_BUDGET", 60))
+
 logger = logging.getLogger("BotSadykhan")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
 formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
 
 file_handler = RotatingFileHandler("app.log", maxBytes=5*1024*1024, backupCount=3, encoding="utf-8")
 file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler без подготовки записи: стандартный prepare() собирает сообщение
+    в вызывающем потоке, а здесь это делает уже поток QueueListener."""
+
+    def prepare(self, record):
+        # Очередь живёт в этом же процессе, пиклить запись не нужно
+        return record
+
+# Event loop только кладёт запись в очередь; сборка сообщения и запись на диск — в фоновом потоке.
+# Изменяемые аргументы к моменту записи могут поменяться, поэтому дампы передаются через snapshot()
+log_queue = queue.SimpleQueue()
+logger.addHandler(DeferredQueueHandler(log_queue))
+log_listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+def snapshot(data: dict) -> dict:
+    """Копия данных FSM для отложенного лога: вложенные списки (scores) копируются тоже."""
+    return {k: list(v) if isinstance(v, list) else v for k, v in data.items()}
+
+def stop_logging():
+    """Дописывает очередь логов; повторный вызов при выходе уже не нужен.
+
+    Вызывается после asyncio.run(main()): записи остановки (runner.cleanup, отмена задач,
+    завершение polling) иначе остались бы в очереди без читателя."""
+    atexit.unregister(log_listener.stop)
+    log_listener.stop()
+
+class DumpLimiter:
+    """Пропускает объёмные отладочные дампы (апдейты, состояние FSM) с долей sample_rate
+    и не чаще budget раз в минуту, чтобы под нагрузкой они не забивали лог и очередь."""
+
+    def __init__(self, sample_rate: float, budget: int):
+        self.sample_rate = sample_rate
+        self.budget = budget
+        self._window = 0.0
+        self._used = 0
+        self.suppressed = 0
+
+    def allow(self) -> bool:
+        if not logger.isEnabledFor(logging.DEBUG):
+            return False
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        now = time.monotonic()
+        if now - self._window >= 60:
+            if self.suppressed:
+                logger.info("%s debug dumps suppressed in the last minute (LOG_DUMP_BUDGET=%s)",
+                            self.suppressed, self.budget)
+            self._window = now
+            self._used = 0
+            self.suppressed = 0
+        if self._used >= self.budget:
+            self.suppressed += 1
+            return False
+        self._used += 1
+        return True
+
+dumps = DumpLimiter(LOG_DUMP_SAMPLE_RATE, LOG_DUMP_BUDGET)
 
 # === Загрузка конфигов ===
-load_dotenv()
 API_TOKEN = os.getenv("API_TOKEN")
 CHAT_ID = int(os.getenv("CHAT_ID", "0"))
 TEMPLATE_PATH = os.getenv("TEMPLATE_PATH", "template.xlsx")
 CHECKLIST_PATH = os.getenv("CHECKLIST_PATH", "checklist.xlsx")
+CHECKLIST_CACHE_DIR = os.getenv("CHECKLIST_CACHE_DIR", ".checklist_cache")
+CHECKLIST_RELOAD_INTERVAL = int(os.getenv("CHECKLIST_RELOAD_INTERVAL", 60))
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
 LOG_PATH = os.getenv("LOG_PATH", "checklist_log.csv")
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", 100))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", 1.0))
+AUDIT_DB_PATH = os.getenv("AUDIT_DB_PATH", "audits.db")
 PORT = int(os.getenv("PORT", 8080))
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", os.cpu_count() or 2))
+REPORT_EXECUTOR = os.getenv("REPORT_EXECUTOR", "process")
+REDIS_URL = os.getenv("REDIS_URL")
+SESSION_TTL = int(os.getenv("SESSION_TTL", 86400))
+CHECKPOINT_INTERVAL = float(os.getenv("CHECKPOINT_INTERVAL", 1.0))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 4))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 10))
+OUTBOX_BASE_DELAY = float(os.getenv("OUTBOX_BASE_DELAY", 2.0))
+OUTBOX_MAX_DELAY = float(os.getenv("OUTBOX_MAX_DELAY", 600))
+OUTBOX_RETENTION_DAYS = float(os.getenv("OUTBOX_RETENTION_DAYS", 30))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 25))
+DELETE_WEBHOOK_ON_SHUTDOWN = os.getenv("DELETE_WEBHOOK_ON_SHUTDOWN", "0").lower() in ("1", "true", "yes")
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 16))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_DEDUPE_WINDOW = int(os.getenv("UPDATE_DEDUPE_WINDOW", 10000))
+SEND_RATE_GLOBAL = float(os.getenv("SEND_RATE_GLOBAL", 30))
+SEND_RATE_CHAT = float(os.getenv("SEND_RATE_CHAT", 1))
+SEND_RATE_GROUP = float(os.getenv("SEND_RATE_GROUP", 20 / 60))
+SEND_BURST_CHAT = int(os.getenv("SEND_BURST_CHAT", 5))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 3))
+SINGLE_MESSAGE_MODE = os.getenv("SINGLE_MESSAGE_MODE", "0").lower() in ("1", "true", "yes")
 
 logger.info("Bot configuration loaded.")
 logger.debug("API_TOKEN is set: [REDACTED]")
-logger.debug(f"CHAT_ID: {CHAT_ID}")
-logger.debug(f"TEMPLATE_PATH: {TEMPLATE_PATH}")
-logger.debug(f"CHECKLIST_PATH: {CHECKLIST_PATH}")
-logger.debug(f"LOG_PATH: {LOG_PATH}")
-logger.debug(f"PORT: {PORT}")
-logger.debug(f"WEBHOOK_URL: {WEBHOOK_URL}")
+logger.debug("LOG_LEVEL: %s", LOG_LEVEL)
+logger.debug("LOG_DUMP_SAMPLE_RATE: %s", LOG_DUMP_SAMPLE_RATE)
+logger.debug("LOG_DUMP_BUDGET: %s", LOG_DUMP_BUDGET)
+logger.debug("CHAT_ID: %s", CHAT_ID)
+logger.debug("TEMPLATE_PATH: %s", TEMPLATE_PATH)
+logger.debug("CHECKLIST_PATH: %s", CHECKLIST_PATH)
+logger.debug("CHECKLIST_CACHE_DIR: %s", CHECKLIST_CACHE_DIR)
+logger.debug("CHECKLIST_RELOAD_INTERVAL: %s", CHECKLIST_RELOAD_INTERVAL)
+logger.debug("ADMIN_IDS: %s", sorted(ADMIN_IDS))
+logger.debug("LOG_PATH: %s", LOG_PATH)
+logger.debug("LOG_BATCH_SIZE: %s", LOG_BATCH_SIZE)
+logger.debug("LOG_FLUSH_INTERVAL: %s", LOG_FLUSH_INTERVAL)
+logger.debug("AUDIT_DB_PATH: %s", AUDIT_DB_PATH)
+logger.debug("PORT: %s", PORT)
+logger.debug("WEBHOOK_URL: %s", WEBHOOK_URL)
+logger.debug("TELEGRAM_API_URL: %s", TELEGRAM_API_URL)
+logger.debug("REPORT_WORKERS: %s", REPORT_WORKERS)
+logger.debug("REPORT_EXECUTOR: %s", REPORT_EXECUTOR)
+logger.debug("REDIS_URL is set: %s", bool(REDIS_URL))
+logger.debug("SESSION_TTL: %s", SESSION_TTL)
+logger.debug("CHECKPOINT_INTERVAL: %s", CHECKPOINT_INTERVAL)
+logger.debug("OUTBOX_WORKERS: %s", OUTBOX_WORKERS)
+logger.debug("OUTBOX_MAX_ATTEMPTS: %s", OUTBOX_MAX_ATTEMPTS)
+logger.debug("OUTBOX_BASE_DELAY: %s", OUTBOX_BASE_DELAY)
+logger.debug("OUTBOX_MAX_DELAY: %s", OUTBOX_MAX_DELAY)
+logger.debug("OUTBOX_RETENTION_DAYS: %s", OUTBOX_RETENTION_DAYS)
+logger.debug("SHUTDOWN_TIMEOUT: %s", SHUTDOWN_TIMEOUT)
+logger.debug("DELETE_WEBHOOK_ON_SHUTDOWN: %s", DELETE_WEBHOOK_ON_SHUTDOWN)
+logger.debug("UPDATE_WORKERS: %s", UPDATE_WORKERS)
+logger.debug("UPDATE_QUEUE_SIZE: %s", UPDATE_QUEUE_SIZE)
+logger.debug("UPDATE_DEDUPE_WINDOW: %s", UPDATE_DEDUPE_WINDOW)
+logger.debug("SEND_RATE_GLOBAL: %s", SEND_RATE_GLOBAL)
+logger.debug("SEND_RATE_CHAT: %s", SEND_RATE_CHAT)
+logger.debug("SEND_RATE_GROUP: %s", SEND_RATE_GROUP)
+logger.debug("SEND_BURST_CHAT: %s", SEND_BURST_CHAT)
+logger.debug("SEND_MAX_RETRIES: %s", SEND_MAX_RETRIES)
+logger.debug("SINGLE_MESSAGE_MODE: %s", SINGLE_MESSAGE_MODE)
 
 # === FSM-состояния ===
 class Form(StatesGroup):
@@ -64,55 +214,1293 @@ class Form(StatesGroup):
     comment = State()
 
 # === Читаем критерии из Excel ===
-criteria = []
-try:
-    logger.info(f"Reading checklist from: {CHECKLIST_PATH}")
-    df = pd.read_excel(CHECKLIST_PATH, sheet_name="Чек лист", header=None)
-    start_i = df[df.iloc[:, 0] == "Блок"].index[0] + 1
-    df = df.iloc[start_i:, :8].reset_index(drop=True)
-    df.columns = ["Блок", "Критерий", "Требование", "Оценка", "Макс", "Примечание", "Дата проверки", "Дата исправления"]
-
-    last_block = "Неизвестный блок"
-    for _, row in df.iterrows():
-        if pd.isna(row["Критерий"]) or pd.isna(row["Требование"]):
+CHECKLIST_SHEET = "Чек лист"
+
+def _max_score(value) -> int:
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = str(value)
+    return int(text) if text.isdigit() else 10
+
+def parse_checklist(path: str) -> list:
+    """Потоковый разбор листа чек-листа через openpyxl read_only, без pandas."""
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb[CHECKLIST_SHEET].iter_rows(max_col=8, values_only=True)
+        # Таблица начинается после строки заголовков с «Блок» в первой колонке
+        for row in rows:
+            if row and row[0] == "Блок":
+                break
+        else:
+            raise ValueError(f"Header row 'Блок' not found in sheet '{CHECKLIST_SHEET}'")
+
+        result = []
+        last_block = "Неизвестный блок"
+        for row in rows:
+            row = tuple(row) + (None,) * (5 - len(row))
+            block, criterion, requirement, _, max_value = row[:5]
+            if criterion is None or requirement is None:
+                continue
+            block = block if block is not None else last_block
+            last_block = block
+            result.append({
+                "block": block,
+                "criterion": str(criterion),
+                "requirement": str(requirement),
+                "max": _max_score(max_value)
+            })
+        return result
+    finally:
+        wb.close()
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def load_criteria(path: str, cache_dir: str) -> list:
+    """Критерии из скомпилированного JSON-кэша по хэшу исходника; xlsx разбирается, только если он изменился."""
+    source_hash = file_hash(path)
+    cache_path = os.path.join(cache_dir, f"{source_hash[:16]}.json")
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("source_hash") == source_hash:
+            logger.info("Checklist loaded from cache: %s", cache_path)
+            return cached["criteria"]
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("Ignoring broken checklist cache %s: %s", cache_path, e)
+
+    started = time.perf_counter()
+    result = parse_checklist(path)
+    logger.info("Checklist parsed from %s in %.3fs", path, time.perf_counter() - started)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"source_hash": source_hash, "criteria": result}, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.warning("Failed to write checklist cache %s: %s", cache_path, e)
+    return result
+
+# === Готовые вопросы ===
+def progress_line(step: int, total: int, width: int = 10) -> str:
+    filled = step * width // total if total else 0
+    return f"{'▰' * filled}{'▱' * (width - filled)} {step}/{total}"
+
+def build_questions(criteria: list) -> list:
+    """Текст и клавиатура каждого вопроса собираются один раз при загрузке чек-листа."""
+    total = len(criteria)
+    questions = []
+    for step, criterion in enumerate(criteria):
+        text = (
+            f"<b>Вопрос {step + 1} из {total}</b>\n\n"
+            f"<b>Блок:</b> {criterion['block']}\n"
+            f"<b>Критерий:</b> {criterion['criterion']}\n"
+            f"<b>Требование:</b> {criterion['requirement']}\n"
+            f"<b>Макс. балл:</b> {criterion['max']}"
+        )
+        if SINGLE_MESSAGE_MODE:
+            text = f"{progress_line(step, total)}\n\n{text}"
+        kb = InlineKeyboardBuilder()
+        start_score = 0 if criterion["max"] == 1 else 1
+        for i in range(start_score, criterion["max"] + 1):
+            kb.button(text=str(i), callback_data=f"score_{step}_{i}")
+        if step > 0:
+            kb.button(text="◀️ Назад", callback_data=f"prev_{step}")
+        kb.adjust(5)
+        questions.append((text, kb.as_markup()))
+    return questions
+
+# === Реестр версий чек-листа ===
+REQUIRED_KEYS = ["block", "criterion", "requirement", "max"]
+
+def validate_criteria(criteria: list) -> list:
+    """Проверяем критерии при загрузке, а не на каждом шаге проверки."""
+    valid = []
+    for position, criterion in enumerate(criteria):
+        missing_keys = [key for key in REQUIRED_KEYS if criterion.get(key) is None or str(criterion[key]).strip() == ""]
+        if missing_keys:
+            logger.error("Criterion %s skipped, missing or empty keys: %s", position + 1, missing_keys)
             continue
+        valid.append(criterion)
+    return valid
 
-        block = row["Блок"] if pd.notna(row["Блок"]) else last_block
-        last_block = block
-        max_value = str(row["Макс"])
-        max_score = int(max_value) if max_value.isdigit() else 10
-        criteria.append({
-            "block": block,
-            "criterion": str(row["Критерий"]),
-            "requirement": str(row["Требование"]),
-            "max": max_score
-        })
-    logger.info(f"Loaded {len(criteria)} criteria.")
-    logger.debug(f"Criteria content: {criteria}")
-except Exception as e:
-    logger.error(f"Error reading checklist: {e}", exc_info=True)
+class Checklist:
+    """Неизменяемая версия чек-листа: критерии, готовые вопросы и идентификатор версии.
+
+    Сессия хранит только оценки по позициям критериев и версию, тексты берутся отсюда.
+    """
+
+    def __init__(self, criteria: list):
+        self.criteria = validate_criteria(criteria)
+        self.version = hashlib.sha1(
+            json.dumps(self.criteria, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:12]
+        self.questions = build_questions(self.criteria)
+
+    def __len__(self):
+        return len(self.criteria)
+
+class ChecklistRegistry:
+    """Версии чек-листа с горячей перезагрузкой.
+
+    Новая версия собирается в отдельном потоке и подменяет текущую одной операцией присваивания;
+    начатые проверки остаются на своей версии до конца.
+    """
+
+    def __init__(self, path: str, cache_dir: str):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.current = Checklist([])
+        self._versions = {}
+        self._mtime = None
+        self._reload_lock = asyncio.Lock()
+
+    def _version_path(self, version: str) -> str:
+        return os.path.join(self.cache_dir, f"v_{version}.json")
+
+    def _build(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        return mtime, Checklist(load_criteria(self.path, self.cache_dir))
+
+    def _activate(self, mtime, checklist: Checklist) -> bool:
+        self._mtime = mtime
+        if checklist.version == self.current.version:
+            return False
+        self._versions[checklist.version] = checklist
+        try:
+            # Сохраняем версию, чтобы после рестарта можно было довести начатые на ней проверки
+            path = self._version_path(checklist.version)
+            if not os.path.exists(path):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                    json.dump(checklist.criteria, f, ensure_ascii=False)
+                os.replace(f"{path}.tmp", path)
+        except Exception as e:
+            logger.warning("Failed to store checklist version %s: %s", checklist.version, e)
+        self.current = checklist
+        logger.info("Checklist version %s activated with %s criteria", checklist.version, len(checklist))
+        return True
+
+    def load(self):
+        """Первичная синхронная загрузка при старте."""
+        try:
+            logger.info("Reading checklist from: %s", self.path)
+            self._activate(*self._build())
+            if dumps.allow():
+                logger.debug("Criteria content: %s", self.current.criteria)
+        except Exception as e:
+            logger.error("Error reading checklist: %s", e, exc_info=True)
+
+    def get(self, version: str):
+        """Версия, на которой начата проверка, или None, если она неизвестна."""
+        checklist = self._versions.get(version)
+        if checklist is None and version:
+            try:
+                with open(self._version_path(version), encoding="utf-8") as f:
+                    checklist = Checklist(json.load(f))
+                if checklist.version == version:
+                    self._versions[version] = checklist
+                    logger.info("Checklist version %s restored from cache", version)
+                else:
+                    checklist = None
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning("Failed to restore checklist version %s: %s", version, e)
+        return checklist
+
+    async def resolve(self, version: str):
+        """Как get(), но при промахе сначала перечитывает файл.
+
+        С несколькими экземплярами за балансировщиком проверку могли начать на версии, которую
+        этот экземпляр ещё не подхватил (watch опрашивает файл раз в интервал, /reload доходит
+        до одного экземпляра). Сессия сбрасывается, только если версия неизвестна и после этого.
+        """
+        checklist = self.get(version)
+        if checklist is None and version:
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error("Error reloading checklist: %s", e, exc_info=True)
+            checklist = self.get(version)
+        return checklist
+
+    async def reload(self, force: bool = False) -> bool:
+        """Перечитывает файл, если он изменился (или force). True — активирована новая версия."""
+        async with self._reload_lock:
+            mtime = await asyncio.to_thread(lambda: os.stat(self.path).st_mtime_ns)
+            if not force and mtime == self._mtime:
+                return False
+            mtime, checklist = await asyncio.to_thread(self._build)
+            if not checklist.criteria:
+                logger.error("Checklist %s has no valid criteria, keeping version %s", self.path, self.current.version)
+                return False
+            return self._activate(mtime, checklist)
+
+    async def watch(self, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error("Error reloading checklist: %s", e, exc_info=True)
+
+checklists = ChecklistRegistry(CHECKLIST_PATH, CHECKLIST_CACHE_DIR)
+checklists.load()
 
 # === Утилиты ===
 def now_ts():
     return datetime.now(pytz.timezone("Asia/Almaty")).strftime("%Y-%m-%d %H:%M:%S")
 
-async def log_csv(pharm, name, ts, score, total):
-    first = not os.path.exists(LOG_PATH)
+# === Метрики (формат Prometheus) ===
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (4096, 8192, 16384, 32768, 65536, 131072, 262144, 524288, 1048576)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_value(value) -> str:
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+class Metric:
+    """Метрика с метками; значения хранятся по кортежу значений меток."""
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _series(self, key: tuple, suffix: str = "", extra: tuple = ()) -> str:
+        pairs = [f'{label}="{_escape_label(value)}"' for label, value in (*zip(self.labels, key), *extra)]
+        return f"{self.name}{suffix}{{{','.join(pairs)}}}" if pairs else f"{self.name}{suffix}"
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self._series(key), value
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{series} {_format_value(value)}" for series, value in self.samples()]
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [[0] * len(self.buckets), 0, 0]
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield self._series(key, "_bucket", (("le", _format_value(bound)),)), cumulative
+            yield self._series(key, "_bucket", (("le", "+Inf"),)), count
+            yield self._series(key, "_sum"), total
+            yield self._series(key, "_count"), count
+
+    def timed(self, **labels):
+        """Декоратор корутины: длительность каждого вызова попадает в гистограмму."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines += metric.expose()
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.register(Histogram(
+    "bot_handler_duration_seconds", "Время выполнения обработчиков бота", ("handler",)))
+TELEGRAM_LATENCY = metrics.register(Histogram(
+    "bot_telegram_request_duration_seconds", "Время запросов к Telegram Bot API", ("method",)))
+TELEGRAM_ERRORS = metrics.register(Counter(
+    "bot_telegram_errors_total", "Ошибки запросов к Telegram Bot API", ("method", "error")))
+REPORT_SIZE = metrics.register(Histogram(
+    "bot_report_size_bytes", "Размер сформированных отчётов", buckets=SIZE_BUCKETS))
+WEBHOOK_QUEUE_DEPTH = metrics.register(Gauge(
+    "bot_webhook_queue_depth", "Обновления вебхука, ожидающие обработки"))
+FSM_SESSIONS = metrics.register(Gauge(
+    "bot_fsm_active_sessions", "Чаты с активным состоянием FSM"))
+REPORT_JOBS = metrics.register(Gauge(
+    "bot_report_jobs", "Задачи пула отчётов", ("state",)))
+
+# === Журнал проверок (CSV) ===
+class AuditLogWriter:
+    """Единственный писатель CSV-журнала: записи копятся в очереди и сбрасываются пачками.
+
+    Пачка пишется по достижении batch_size записей или через flush_interval секунд после первой,
+    одним открытием файла и одним fsync. Поля экранируются модулем csv.
+    """
+
+    HEADER = ["Дата", "Аптека", "Проверяющий", "Баллы", "Макс"]
+    _STOP = object()
+
+    def __init__(self, path: str, batch_size: int, flush_interval: float):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue = None
+        self._task = None
+        self.written = 0
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run(), name="audit-log-writer")
+
+    def write(self, pharm, name, ts, score, total):
+        self.start()
+        self._queue.put_nowait([ts, pharm, name, score, total])
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            record = await self._queue.get()
+            if record is self._STOP:
+                break
+            batch = [record]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if record is self._STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+            await asyncio.to_thread(self._write_batch, batch)
+
+    def _write_batch(self, batch: list):
+        try:
+            first = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, "a", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                if first:
+                    writer.writerow(self.HEADER)
+                writer.writerows(batch)
+                f.flush()
+                os.fsync(f.fileno())
+            self.written += len(batch)
+            logger.debug("Audit log: %s records flushed to %s", len(batch), self.path)
+        except Exception as e:
+            logger.error("Error writing to log: %s", e, exc_info=True)
+
+    async def close(self):
+        """Дописывает всё, что осталось в очереди, и останавливает писателя."""
+        if self._task is None:
+            return
+        self._queue.put_nowait(self._STOP)
+        await self._task
+        self._task = None
+
+audit_log = AuditLogWriter(LOG_PATH, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL)
+
+# === Хранилище проверок (SQLite) ===
+class AuditStore:
+    """Завершённые проверки с оценками по каждому критерию во встроенной SQLite в режиме WAL.
+
+    Все запросы выполняются в одном выделенном потоке с единственным соединением,
+    поэтому event loop не блокируется, а запись не конкурирует сама с собой.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS audits (
+            id INTEGER PRIMARY KEY,
+            pharmacy TEXT NOT NULL,
+            auditor TEXT NOT NULL,
+            user_id INTEGER,
+            started_at TEXT NOT NULL,
+            audit_date TEXT NOT NULL,
+            checklist_version TEXT,
+            total_score INTEGER NOT NULL,
+            total_max INTEGER NOT NULL,
+            comment TEXT
+        );
+        CREATE TABLE IF NOT EXISTS audit_scores (
+            audit_id INTEGER NOT NULL REFERENCES audits(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            block TEXT NOT NULL,
+            criterion TEXT NOT NULL,
+            requirement TEXT,
+            score INTEGER NOT NULL,
+            max_score INTEGER NOT NULL,
+            PRIMARY KEY (audit_id, position)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_audits_pharmacy ON audits(pharmacy, audit_date);
+        CREATE INDEX IF NOT EXISTS idx_audits_auditor ON audits(auditor, audit_date);
+        CREATE INDEX IF NOT EXISTS idx_audits_date ON audits(audit_date);
+        CREATE INDEX IF NOT EXISTS idx_scores_criterion ON audit_scores(block, criterion);
+        CREATE TABLE IF NOT EXISTS sessions (
+            key TEXT PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS report_outbox (
+            id INTEGER PRIMARY KEY,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            report_key TEXT NOT NULL,
+            user_id INTEGER,
+            chat_id INTEGER NOT NULL,
+            file_name TEXT NOT NULL,
+            content BLOB,
+            file_id TEXT,
+            caption TEXT,
+            notice TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_outbox_due ON report_outbox(status, next_attempt_at);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audit-db")
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.executescript(self.SCHEMA)
+            self._conn = conn
+            logger.info("Audit database opened: %s", self.path)
+        return self._conn
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _query(self, sql: str, params=()) -> list:
+        return [dict(row) for row in self._connect().execute(sql, params)]
+
+    def _save(self, audit: dict, rows: list) -> int:
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO audits (pharmacy, auditor, user_id, started_at, audit_date, checklist_version, "
+                "total_score, total_max, comment) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (audit["pharmacy"], audit["auditor"], audit.get("user_id"), audit["started_at"],
+                 audit["started_at"][:10], audit.get("checklist_version"), audit["total_score"],
+                 audit["total_max"], audit.get("comment", "")),
+            )
+            audit_id = cursor.lastrowid
+            conn.executemany(
+                "INSERT INTO audit_scores (audit_id, position, block, criterion, requirement, score, max_score) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(audit_id, position, *row) for position, row in enumerate(rows)],
+            )
+        return audit_id
+
+    async def save_audit(self, audit: dict, rows: list) -> int:
+        """Сохраняет проверку и её строки (блок, критерий, требование, оценка, макс)."""
+        return await self._call(self._save, audit, rows)
+
+    async def pharmacy_scores(self, pharmacy: str, since: str = None, until: str = None) -> list:
+        """Итоги проверок аптеки по времени; since/until — даты YYYY-MM-DD включительно."""
+        return await self._call(self._query, """
+            SELECT id, started_at, auditor, total_score, total_max,
+                   ROUND(100.0 * total_score / NULLIF(total_max, 0), 1) AS percent
+            FROM audits
+            WHERE pharmacy = ? AND audit_date >= ? AND audit_date <= ?
+            ORDER BY audit_date, started_at
+        """, (pharmacy, since or "0000-00-00", until or "9999-99-99"))
+
+    async def weakest_criteria(self, limit: int = 3, pharmacy: str = None, since: str = None,
+                               until: str = None) -> list:
+        """Для каждого блока — limit критериев с самым низким средним процентом от максимума."""
+        return await self._call(self._query, """
+            SELECT block, criterion, audits, avg_score, avg_max, percent FROM (
+                SELECT s.block, s.criterion, COUNT(*) AS audits,
+                       ROUND(AVG(s.score), 2) AS avg_score, ROUND(AVG(s.max_score), 2) AS avg_max,
+                       ROUND(100.0 * SUM(s.score) / NULLIF(SUM(s.max_score), 0), 1) AS percent,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY s.block
+                           ORDER BY 1.0 * SUM(s.score) / NULLIF(SUM(s.max_score), 0)
+                       ) AS rank
+                FROM audit_scores s JOIN audits a ON a.id = s.audit_id
+                WHERE a.audit_date >= ? AND a.audit_date <= ? AND (? IS NULL OR a.pharmacy = ?)
+                GROUP BY s.block, s.criterion
+            )
+            WHERE rank <= ?
+            ORDER BY block, rank
+        """, (since or "0000-00-00", until or "9999-99-99", pharmacy, pharmacy, limit))
+
+    async def auditor_averages(self, since: str = None, until: str = None) -> list:
+        """Число проверок и средний результат каждого проверяющего."""
+        return await self._call(self._query, """
+            SELECT auditor, COUNT(*) AS audits, ROUND(AVG(total_score), 2) AS avg_score,
+                   ROUND(100.0 * SUM(total_score) / NULLIF(SUM(total_max), 0), 1) AS percent
+            FROM audits
+            WHERE audit_date >= ? AND audit_date <= ?
+            GROUP BY auditor
+            ORDER BY auditor
+        """, (since or "0000-00-00", until or "9999-99-99"))
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _save_sessions(self, rows: list, deleted: list):
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT INTO sessions (key, chat_id, state, data, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                "updated_at = excluded.updated_at",
+                rows,
+            )
+            conn.executemany("DELETE FROM sessions WHERE key = ?", [(key,) for key in deleted])
+
+    def _load_sessions(self, max_age: float) -> list:
+        conn = self._connect()
+        if max_age:
+            with conn:
+                conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - max_age,))
+        return self._query("SELECT key, state, data FROM sessions")
+
+    async def save_sessions(self, rows: list, deleted: list):
+        """Контрольные точки незавершённых проверок: rows — (ключ, chat_id, состояние, данные JSON, время)."""
+        await self._call(self._save_sessions, rows, deleted)
+
+    async def load_sessions(self, max_age: float = 0) -> list:
+        """Сохранённые сессии; более старые, чем max_age секунд, удаляются."""
+        return await self._call(self._load_sessions, max_age)
+
+    def _execute(self, sql: str, params=()) -> int:
+        conn = self._connect()
+        with conn:
+            return conn.execute(sql, params).rowcount
+
+    def _enqueue_reports(self, rows: list) -> int:
+        conn = self._connect()
+        before = conn.total_changes
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO report_outbox (idempotency_key, report_key, user_id, chat_id, file_name, "
+                "content, caption, notice, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return conn.total_changes - before
+
+    def _mark_report_sent(self, outbox_id: int, report_key: str, file_id: str):
+        conn = self._connect()
+        with conn:
+            conn.execute("UPDATE report_outbox SET status = 'sent', content = NULL, file_id = ?, last_error = NULL "
+                         "WHERE id = ?", (file_id, outbox_id))
+            # Остальные получатели того же отчёта получат уже загруженный файл
+            conn.execute("UPDATE report_outbox SET file_id = ?, content = NULL "
+                         "WHERE report_key = ? AND status = 'pending' AND file_id IS NULL", (file_id, report_key))
+
+    async def enqueue_reports(self, rows: list) -> int:
+        """Кладёт доставки в outbox; повторные idempotency_key игнорируются. Возвращает число новых строк."""
+        return await self._call(self._enqueue_reports, rows)
+
+    async def due_reports(self, now: float, limit: int = 100) -> list:
+        return await self._call(self._query, """
+            SELECT * FROM report_outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY id LIMIT ?
+        """, (now, limit))
+
+    async def next_report_due(self):
+        rows = await self._call(self._query, """
+            SELECT MIN(next_attempt_at) AS due FROM report_outbox WHERE status = 'pending'
+        """)
+        return rows[0]["due"]
+
+    async def mark_report_sent(self, outbox_id: int, report_key: str, file_id: str):
+        await self._call(self._mark_report_sent, outbox_id, report_key, file_id)
+
+    async def mark_report_retry(self, outbox_id: int, next_attempt_at: float, error: str):
+        await self._call(self._execute, "UPDATE report_outbox SET attempts = attempts + 1, next_attempt_at = ?, "
+                         "last_error = ? WHERE id = ?", (next_attempt_at, error, outbox_id))
+
+    async def mark_report_failed(self, outbox_id: int, error: str):
+        # Повторов не будет: сам файл больше не нужен, остаётся только запись о сбое
+        await self._call(self._execute, "UPDATE report_outbox SET status = 'failed', attempts = attempts + 1, "
+                         "content = NULL, last_error = ? WHERE id = ?", (error, outbox_id))
+
+    async def prune_reports(self, before: float) -> int:
+        """Удаляет отправленные и брошенные доставки, созданные раньше before. Возвращает число строк."""
+        return await self._call(self._execute, "DELETE FROM report_outbox WHERE status IN ('sent', 'failed') "
+                                "AND created_at < ?", (before,))
+
+    async def close(self):
+        await self._call(self._close)
+        self._executor.shutdown(wait=True)
+
+audit_store = AuditStore(AUDIT_DB_PATH)
+
+# === Сводная выгрузка проверок ===
+EXPORT_BATCH_SIZE = 500
+SUMMARY_SHEET = "Сводка"
+
+def month_range(month: str):
+    """'ГГГГ-ММ' -> первый и последний день месяца для фильтра по audit_date."""
+    # strptime принимает и '2026-1': приводим к виду с нулём, как в audit_date
+    month = datetime.strptime(month, "%Y-%m").strftime("%Y-%m")
+    return f"{month}-01", f"{month}-31"
+
+def _sheet_title(name: str, used: set) -> str:
+    # Excel: до 31 символа, без []:*?/\, уникально без учёта регистра
+    base = re.sub(r"[\[\]:*?/\\]", "_", str(name)).strip() or "Без названия"
+    title = base[:31]
+    n = 2
+    while title.lower() in used:
+        suffix = f" ({n})"
+        title = base[:31 - len(suffix)] + suffix
+        n += 1
+    used.add(title.lower())
+    return title
+
+def export_audits(db_path: str, out, since: str = None, until: str = None) -> int:
+    """Потоковая выгрузка проверок в одну книгу: лист «Сводка» и по листу на каждую аптеку.
+
+    Строки читаются из SQLite порциями и сразу пишутся в openpyxl write-only,
+    поэтому память не зависит от числа проверок. Возвращает число выгруженных проверок.
+    """
+    if not os.path.exists(db_path):
+        raise FileNotFoundError(db_path)
+    params = (since or "0000-00-00", until or "9999-99-99")
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
     try:
-        async with aiofiles.open(LOG_PATH, "a", newline="", encoding="utf-8") as f:
-            if first:
-                await f.write(",".join(["Дата", "Аптека", "Проверяющий", "Баллы", "Макс"]) + "\n")
-            await f.write(",".join([ts, pharm, name, str(score), str(total)]) + "\n")
-    except Exception as e:
-        logger.error(f"Error writing to log: {e}", exc_info=True)
+        wb = Workbook(write_only=True)
+        used_titles = {SUMMARY_SHEET.lower()}
+
+        summary = wb.create_sheet(SUMMARY_SHEET)
+        summary.append(["Аптека", "Дата", "Проверяющий", "Баллы", "Макс", "%", "Версия чек-листа", "Вывод проверяющего"])
+        count = 0
+        cursor = conn.execute("""
+            SELECT pharmacy, started_at, auditor, total_score, total_max, checklist_version, comment
+            FROM audits WHERE audit_date >= ? AND audit_date <= ?
+            ORDER BY pharmacy, started_at, id
+        """, params)
+        while rows := cursor.fetchmany(EXPORT_BATCH_SIZE):
+            for pharmacy, started_at, auditor, score, max_score, version, comment in rows:
+                percent = round(100 * score / max_score, 1) if max_score else None
+                summary.append([pharmacy, started_at, auditor, score, max_score, percent, version, comment])
+                count += 1
+
+        sheet = None
+        current = None
+        cursor = conn.execute("""
+            SELECT a.pharmacy, a.started_at, a.auditor, s.block, s.criterion, s.score, s.max_score
+            FROM audits a JOIN audit_scores s ON s.audit_id = a.id
+            WHERE a.audit_date >= ? AND a.audit_date <= ?
+            ORDER BY a.pharmacy, a.started_at, a.id, s.position
+        """, params)
+        while rows := cursor.fetchmany(EXPORT_BATCH_SIZE):
+            for pharmacy, started_at, auditor, block, criterion, score, max_score in rows:
+                if pharmacy != current:
+                    current = pharmacy
+                    sheet = wb.create_sheet(_sheet_title(pharmacy, used_titles))
+                    sheet.append(["Дата", "Проверяющий", "Блок", "Критерий", "Оценка", "Макс"])
+                sheet.append([started_at, auditor, block, criterion, score, max_score])
+
+        wb.save(out)
+        return count
+    finally:
+        conn.close()
+
+def export_cli(argv: list):
+    parser = argparse.ArgumentParser(prog="Bot_Sadykhan.py export", description="Сводная выгрузка проверок в xlsx")
+    parser.add_argument("output", help="путь к создаваемому .xlsx")
+    parser.add_argument("--month", help="месяц ГГГГ-ММ")
+    parser.add_argument("--since", help="с даты ГГГГ-ММ-ДД")
+    parser.add_argument("--until", help="по дату ГГГГ-ММ-ДД")
+    parser.add_argument("--db", default=AUDIT_DB_PATH, help="база проверок")
+    args = parser.parse_args(argv)
+    since, until = month_range(args.month) if args.month else (args.since, args.until)
+    started = time.perf_counter()
+    count = export_audits(args.db, args.output, since, until)
+    logger.info("Exported %s audits to %s in %.2fs", count, args.output, time.perf_counter() - started)
+
+# === Пул генерации отчётов ===
+def _init_report_worker():
+    # В форкнутом процессе нет потока QueueListener. В app.log пишет только родитель:
+    # RotatingFileHandler не рассчитан на запись и ротацию одного файла из нескольких процессов.
+    # Воркеры логируют редко (разбор шаблона), ошибки задач возвращаются родителю через future
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(console_handler)
+    # Пул, пересозданный после падения воркера, форкается уже после loop.add_signal_handler: без сброса
+    # воркер унаследует wakeup fd event loop (SIGTERM воркеру остановил бы весь бот) и не завершится по SIGTERM
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    if sys.platform.startswith("linux"):
+        # Родителя убили (SIGKILL, повторный SIGTERM) — воркер не должен остаться сиротой на чтении из пайпа
+        PR_SET_PDEATHSIG = 1
+        ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+
+class ReportPool:
+    """Ограниченный пул воркеров: отчёты строятся вне event loop, остальные чаты не ждут."""
+
+    def __init__(self, workers: int, kind: str = "process"):
+        self.workers = max(1, workers)
+        self.kind = kind
+        self._executor = None
+        self._slots = asyncio.Semaphore(self.workers)
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                # fork дешевле spawn и не повторяет в воркере побочные эффекты импорта модуля бота
+                # (обработчики логов, загрузка чек-листа). Чтобы форк шёл из процесса почти без потоков,
+                # пул поднимается в start() до открытия базы и пула потоков event loop
+                methods = multiprocessing.get_all_start_methods()
+                ctx = multiprocessing.get_context("fork" if "fork" in methods else None)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx,
+                                                     initializer=_init_report_worker)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="report")
+            logger.info("Report pool started: %s x%s", self.kind, self.workers)
+        return self._executor
+
+    def start(self):
+        """Поднимает воркеры заранее: с fork ProcessPoolExecutor создаёт их все при первой задаче."""
+        executor = self._get_executor()
+        if self.kind == "process":
+            executor.submit(os.getpid).result()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    async def run(self, func, *args):
+        """Ставит задачу в очередь пула и ждёт результат, не блокируя event loop."""
+        enqueued = time.perf_counter()
+        self.queued += 1
+        logger.debug("Report job queued, queue depth: %s, running: %s", self.queued, self.running)
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+        started = time.perf_counter()
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            executor = self._get_executor()
+            try:
+                result = await loop.run_in_executor(executor, func, *args)
+            except BrokenProcessPool as e:
+                # Воркер убит (OOM, segfault) — такой пул больше не примет ни одной задачи.
+                # Пересоздаём его (если этого ещё не сделала соседняя задача) и повторяем один раз
+                logger.error("Report pool is broken (%s), restarting it", e)
+                if self._executor is executor:
+                    self._executor = None
+                    executor.shutdown(wait=False)
+                result = await loop.run_in_executor(self._get_executor(), func, *args)
+            self.completed += 1
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.running -= 1
+            self._slots.release()
+            finished = time.perf_counter()
+            logger.info(
+                "Report job finished: wait=%.3fs, run=%.3fs, queue depth: %s, running: %s",
+                started - enqueued, finished - started, self.queued, self.running
+            )
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+report_pool = ReportPool(REPORT_WORKERS, REPORT_EXECUTOR)
+
+# === Кэш шаблона отчёта ===
+REPORT_HEADERS = ["Блок", "Критерий", "Требование", "Оценка", "Макс", "Коммент.", "Дата проверки"]
+
+class TemplateCache:
+    """Шаблон, разобранный один раз в прототип; перечитывается только при смене mtime файла."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mtime = None
+        self._blob = None
+        self._lock = threading.Lock()
+
+    def _build(self) -> bytes:
+        started = time.perf_counter()
+        wb = load_workbook(self.path)
+        ws = wb.active
+        ws.merge_cells("A1:G2")
+        ws["A1"].font = Font(size=14, bold=True)
+        for idx, header in enumerate(REPORT_HEADERS, start=1):
+            cell = ws.cell(5, idx, header)
+            cell.font = Font(bold=True)
+        # Распаковка pickle в разы быстрее повторного разбора xlsx
+        blob = pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL)
+        logger.info("Report template parsed: %s (%.3fs)", self.path, time.perf_counter() - started)
+        return blob
+
+    def get(self):
+        """Возвращает свежую копию подготовленной книги."""
+        mtime = os.stat(self.path).st_mtime_ns
+        with self._lock:
+            if self._blob is None or mtime != self._mtime:
+                self._blob = self._build()
+                self._mtime = mtime
+            blob = self._blob
+        return pickle.loads(blob)
+
+_template_caches = {}
+
+def get_template(template_path: str):
+    cache = _template_caches.get(template_path)
+    if cache is None:
+        cache = _template_caches.setdefault(template_path, TemplateCache(template_path))
+    return cache.get()
+
+def render_report(template_path: str, report: dict):
+    """Заполняет шаблон и возвращает xlsx в байтах. Выполняется в воркере пула, без обращений к боту."""
+    name = report["name"]
+    ts = report["start"]
+    wb = get_template(template_path)
+    ws = wb.active
+    ws["A1"] = f"Отчёт по проверке аптеки\nИсполнитель: {name}\nДата и время: {ts}"
+    ws["B3"] = report["pharmacy"]
+
+    row = 6
+    total_score = 0
+    total_max = 0
+    for block, criterion, requirement, score, max_score in report["rows"]:
+        ws.cell(row, 1, block)
+        ws.cell(row, 2, criterion)
+        ws.cell(row, 3, requirement)
+        ws.cell(row, 4, score)
+        ws.cell(row, 5, max_score)
+        ws.cell(row, 6, "")
+        ws.cell(row, 7, ts)
+        total_score += score
+        total_max += max_score
+        row += 1
+
+    ws.cell(row + 1, 3, "ИТОГО:")
+    ws.cell(row + 1, 4, total_score)
+    ws.cell(row + 2, 3, "Максимум:")
+    ws.cell(row + 2, 4, total_max)
+    ws.cell(row + 4, 1, "Вывод проверяющего:")
+    ws.cell(row + 5, 1, report["comment"])
+
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue(), total_score, total_max
+
+# === Хранилище FSM ===
+class CheckpointStorage(MemoryStorage):
+    """MemoryStorage, чьи сессии переживают падение процесса.
+
+    Изменения не пишутся на каждое нажатие: ключ лишь помечается изменённым, а раз в interval
+    секунд последние снимки изменённых сессий одной транзакцией сохраняются в SQLite
+    (по строке на сессию). Завершённые и сброшенные сессии из контрольных точек удаляются.
+    """
+
+    def __init__(self, store: AuditStore, interval: float):
+        super().__init__()
+        self.store = store
+        self.interval = interval
+        self._dirty = set()
+        self._flusher = None
+        self.flushes = 0
+
+    async def set_state(self, key: StorageKey, state=None):
+        await super().set_state(key, state)
+        self._mark(key)
+
+    async def set_data(self, key: StorageKey, data):
+        await super().set_data(key, data)
+        self._mark(key)
+
+    def _mark(self, key: StorageKey):
+        self._dirty.add(key)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Изменения, пришедшие во время записи (или не записанные из-за ошибки), уходят следующим проходом
+        while self._dirty:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        rows, deleted = [], []
+        now = time.time()
+        for key in keys:
+            record = self.storage.get(key)
+            name = json.dumps(dataclasses.asdict(key), sort_keys=True)
+            if record is None or record.state is None:
+                deleted.append(name)
+            else:
+                rows.append((name, key.chat_id, record.state, json.dumps(record.data, ensure_ascii=False), now))
+        try:
+            await self.store.save_sessions(rows, deleted)
+            self.flushes += 1
+            logger.debug("Checkpoints flushed: %s saved, %s removed", len(rows), len(deleted))
+        except Exception as e:
+            # Не теряем изменения: попробуем ещё раз со следующей пачкой
+            self._dirty |= keys
+            logger.error("Error saving session checkpoints: %s", e, exc_info=True)
+
+    async def restore(self, max_age: float = 0) -> list:
+        """Поднимает сохранённые сессии, для которых в памяти нет состояния. Возвращает их ключи."""
+        restored = []
+        for row in await self.store.load_sessions(max_age):
+            key = StorageKey(**json.loads(row["key"]))
+            if self.storage.get(key) is not None and self.storage[key].state is not None:
+                continue
+            record = self.storage[key]
+            record.state = row["state"]
+            record.data = json.loads(row["data"])
+            restored.append(key)
+        return restored
+
+def build_storage(redis=None) -> BaseStorage:
+    """MemoryStorage для одного процесса; RedisStorage, если задан REDIS_URL или передан клиент (например, fakeredis).
+
+    В Redis незавершённые проверки переживают рестарт и доступны всем экземплярам бота за балансировщиком,
+    а брошенные сессии удаляются по SESSION_TTL (0 — без TTL).
+    """
+    if redis is None and not REDIS_URL:
+        if CHECKPOINT_INTERVAL > 0:
+            logger.info("Using in-memory FSM storage with checkpoints every %ss", CHECKPOINT_INTERVAL)
+            return CheckpointStorage(audit_store, CHECKPOINT_INTERVAL)
+        logger.info("Using in-memory FSM storage")
+        return MemoryStorage()
+    ttl = SESSION_TTL or None
+    options = {
+        "key_builder": DefaultKeyBuilder(with_bot_id=True),
+        "state_ttl": ttl,
+        "data_ttl": ttl,
+    }
+    if redis is not None:
+        logger.info("Using Redis FSM storage with provided client")
+        return RedisStorage(redis, **options)
+    logger.info("Using Redis FSM storage")
+    return RedisStorage.from_url(REDIS_URL, **options)
+
+# === Порядок обработки внутри чата ===
+class ChatEventIsolation(BaseEventIsolation):
+    """Обновления одного чата обрабатываются строго по очереди, разных чатов — параллельно.
+
+    В отличие от SimpleEventIsolation замок удаляется, когда его никто не держит и не ждёт,
+    поэтому память не растёт с числом чатов.
+    """
+
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            # close() мог очистить словарь, пока обработчик ещё работал
+            if entry[1] == 0 and self._locks.get(key) is entry:
+                del self._locks[key]
+
+    def active(self) -> int:
+        return len(self._locks)
+
+    async def close(self):
+        self._locks.clear()
+
+def build_isolation(storage: BaseStorage) -> BaseEventIsolation:
+    # Несколько экземпляров за балансировщиком упорядочиваются общим замком в Redis
+    if isinstance(storage, RedisStorage):
+        return storage.create_isolation()
+    return ChatEventIsolation()
+
+# === Исходящие запросы к Telegram ===
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """Забирает токен и возвращает 0, либо возвращает, сколько ждать до следующего токена."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def block(self, seconds: float):
+        """Флуд-контроль: токенов не будет ещё seconds секунд."""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Планировщик исходящих запросов бота.
+
+    Общий и поканальный token bucket по лимитам Telegram, приоритет интерактивных сообщений
+    над выгрузкой отчётов, автоматический повтор после RetryAfter и статистика задержек.
+    """
+
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_BULK = 1
+    MAX_IDLE_BUCKETS = 1000
+
+    def __init__(self, rate: float, chat_rate: float, group_rate: float, chat_burst: int, max_retries: int):
+        self._global = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats = {}
+        self._waiters = []
+        self._seq = itertools.count()
+        self._pump = None
+        self._pause_until = 0.0
+        self._latency = collections.defaultdict(lambda: collections.deque(maxlen=1000))
+        self._counts = collections.Counter()
+        self._errors = collections.Counter()
+        self.flood_waits = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_IDLE_BUCKETS:
+                # Полные корзины ничем не отличаются от новых — их можно выбросить
+                for key in [k for k, b in self._chats.items() if b.is_full()]:
+                    del self._chats[key]
+            # Отрицательный chat_id — группа или канал, у них лимит строже
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate if is_group else self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id, priority: int, per_chat: bool = True):
+        if per_chat:
+            bucket = self._chat_bucket(chat_id)
+            while (delay := bucket.take()) > 0:
+                await asyncio.sleep(delay)
+        if not self._waiters and time.monotonic() >= self._pause_until and self._global.take() == 0:
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run_pump())
+        await future
+
+    async def _run_pump(self):
+        # Раздаёт общие токены ожидающим в порядке приоритета, затем очереди
+        while self._waiters:
+            pause = self._pause_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = self._global.take()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            while self._waiters:
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    future.set_result(None)
+                    break
+            else:
+                self._global.tokens += 1
+
+    def _record(self, name: str, started: float, error: Exception = None):
+        elapsed = time.perf_counter() - started
+        self._latency[name].append(elapsed)
+        self._counts[name] += 1
+        TELEGRAM_LATENCY.observe(elapsed, method=name)
+        if error is not None:
+            self._errors[name] += 1
+            TELEGRAM_ERRORS.inc(method=name, error=type(error).__name__)
+
+    def stats(self) -> dict:
+        result = {}
+        for name, samples in self._latency.items():
+            ordered = sorted(samples)
+            result[name] = {
+                "count": self._counts[name],
+                "errors": self._errors[name],
+                "p50": ordered[len(ordered) // 2],
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                "max": ordered[-1],
+            }
+        return result
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        chat_id = getattr(method, "chat_id", None)
+        # answerCallbackQuery и служебные методы в лимиты сообщений не входят
+        limited = chat_id is not None and not isinstance(method, AnswerCallbackQuery)
+        # Правка — ответ на нажатие кнопки, а не новое сообщение: с поканальным токеном
+        # нажатие стоило бы два токена (правка + следующий вопрос) и ~2 с после burst.
+        # Правки идут только через общий лимит, RetryAfter по-прежнему блокирует чат.
+        per_chat = not isinstance(method, EditMessageText)
+        priority = self.PRIORITY_BULK if isinstance(method, SendDocument) else self.PRIORITY_INTERACTIVE
+        attempt = 0
+        while True:
+            if limited:
+                await self._acquire(chat_id, priority, per_chat)
+            started = time.perf_counter()
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self._record(name, started, error=e)
+                self.flood_waits += 1
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                logger.warning("Flood control on %s (chat %s), retry %s in %ss", name, chat_id, attempt, e.retry_after)
+                if limited:
+                    self._chat_bucket(chat_id).block(e.retry_after)
+                    if not per_chat:
+                        await asyncio.sleep(e.retry_after)
+                else:
+                    self._pause_until = max(self._pause_until, time.monotonic() + e.retry_after)
+                    await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                self._record(name, started, error=e)
+                raise
+            self._record(name, started)
+            return response
+
+outbound = OutboundScheduler(SEND_RATE_GLOBAL, SEND_RATE_CHAT, SEND_RATE_GROUP, SEND_BURST_CHAT, SEND_MAX_RETRIES)
+
+# === Обновления в обработке ===
+class InFlightUpdates(BaseMiddleware):
+    """Считает обновления, которые сейчас обрабатываются, чтобы при остановке дождаться их завершения."""
+
+    def __init__(self):
+        self.count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data):
+        self.count += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.count -= 1
+            if self.count == 0:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._idle.wait(), max(0.0, timeout))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+in_flight = InFlightUpdates()
 
 # === Инициализация бота ===
-bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+# TELEGRAM_API_URL — свой сервер Bot API (локальный telegram-bot-api или заглушка для нагрузочных тестов)
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=API_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+bot.session.middleware(outbound)
+storage = build_storage()
+dp = Dispatcher(storage=storage, events_isolation=build_isolation(storage))
 
 # === Команда /start ===
 async def cmd_start(msg: types.Message, state: FSMContext):
-    logger.info(f"User {msg.from_user.id} called /start")
+    logger.info("User %s called /start", msg.from_user.id)
     await state.clear()
     welcome_text = (
         "<b>👋 Добро пожаловать!</b>\n\n"
@@ -137,39 +1525,92 @@ async def cmd_start(msg: types.Message, state: FSMContext):
 
 # === /id для отладки ===
 async def cmd_id(msg: types.Message):
-    logger.info(f"User {msg.from_user.id} called /id")
+    logger.info("User %s called /id", msg.from_user.id)
     await msg.answer(f"<code>{msg.chat.id}</code>")
 
 # === Сброс FSM ===
 async def cmd_reset(msg: types.Message, state: FSMContext):
-    logger.info(f"User {msg.from_user.id} called /сброс")
+    logger.info("User %s called /сброс", msg.from_user.id)
     await state.clear()
     await msg.answer("Состояние сброшено. /start — начать заново")
 
+# === Перезагрузка чек-листа ===
+async def cmd_reload(msg: types.Message):
+    logger.info("User %s called /reload", msg.from_user.id)
+    if msg.from_user.id not in ADMIN_IDS:
+        await msg.answer("⛔ Команда доступна только администраторам.")
+        return
+    try:
+        changed = await checklists.reload(force=True)
+    except Exception as e:
+        logger.error("Error reloading checklist: %s", e, exc_info=True)
+        await msg.answer("❌ Ошибка при загрузке чек-листа.")
+        return
+    current = checklists.current
+    if changed:
+        await msg.answer(f"✅ Загружена версия <code>{current.version}</code>: {len(current)} критериев.\n"
+                         "Начатые проверки завершатся на прежней версии.")
+    else:
+        await msg.answer(f"Чек-лист не изменился, версия <code>{current.version}</code>.")
+
+# === Выгрузка проверок ===
+async def cmd_export(msg: types.Message):
+    logger.info("User %s called /export", msg.from_user.id)
+    if msg.from_user.id not in ADMIN_IDS:
+        await msg.answer("⛔ Команда доступна только администраторам.")
+        return
+    parts = msg.text.split()
+    month = parts[1] if len(parts) > 1 else now_ts()[:7]
+    try:
+        since, until = month_range(month)
+    except ValueError:
+        await msg.answer("Формат: /export ГГГГ-ММ")
+        return
+    await msg.answer(f"⌛ Формирую выгрузку за {month}…")
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        count = await asyncio.to_thread(export_audits, AUDIT_DB_PATH, path, since, until)
+        if count == 0:
+            await msg.answer(f"За {month} проверок нет.")
+            return
+        await bot.send_document(msg.chat.id, FSInputFile(path, filename=f"Проверки_{month}.xlsx"),
+                                caption=f"Проверок за {month}: {count}")
+    except FileNotFoundError:
+        await msg.answer("Проверок пока нет.")
+    except Exception as e:
+        logger.error("Error exporting audits: %s", e, exc_info=True)
+        await msg.answer("❌ Ошибка при формировании выгрузки.")
+    finally:
+        os.remove(path)
+
 # === Обработка ФИО ===
 async def proc_name(msg: types.Message, state: FSMContext):
     name = msg.text.strip()
-    logger.info(f"User {msg.from_user.id} entered name: {name}")
+    logger.info("User %s entered name: %s", msg.from_user.id, name)
     # Инициализируем состояние
     initial_data = {
         "name": name,
-        "step": 0,
-        "data": [],
+        "version": checklists.current.version,
+        "scores": [],
         "start": now_ts()
     }
     await state.set_data(initial_data)
-    logger.debug(f"State set with: {initial_data}")
+    if dumps.allow():
+        logger.debug("State set with: %s", snapshot(initial_data))
     # Проверяем, что данные корректно установлены
     data = await state.get_data()
-    logger.debug(f"State after proc_name: {data}")
-    if "data" not in data or not isinstance(data["data"], list):
-        logger.error("Failed to initialize 'data' key in state")
+    if dumps.allow():
+        logger.debug("State after proc_name: %s", snapshot(data))
+    if not isinstance(data.get("scores"), list):
+        logger.error("Failed to initialize 'scores' key in state")
         # Пробуем повторно установить данные
         await state.set_data(initial_data)
         data = await state.get_data()
-        logger.debug(f"State after retry: {data}")
-        if "data" not in data or not isinstance(data["data"], list):
-            logger.error("Retry failed: 'data' key still missing")
+        if dumps.allow():
+            logger.debug("State after retry: %s", snapshot(data))
+        if not isinstance(data.get("scores"), list):
+            logger.error("Retry failed: 'scores' key still missing")
             await msg.answer("❌ Ошибка: Не удалось инициализировать состояние. Начните заново с /start.")
             await state.clear()
             return
@@ -179,27 +1620,50 @@ async def proc_name(msg: types.Message, state: FSMContext):
 # === Обработка названия аптеки ===
 async def proc_pharmacy(msg: types.Message, state: FSMContext):
     pharmacy = msg.text.strip()
-    logger.info(f"User {msg.from_user.id} entered pharmacy: {pharmacy}")
+    logger.info("User %s entered pharmacy: %s", msg.from_user.id, pharmacy)
     await state.update_data(pharmacy=pharmacy)
     data = await state.get_data()
-    logger.debug(f"State after proc_pharmacy: {data}")
-    if "data" not in data:
-        logger.error("Lost 'data' key after proc_pharmacy")
+    if dumps.allow():
+        logger.debug("State after proc_pharmacy: %s", snapshot(data))
+    if "scores" not in data:
+        logger.error("Lost 'scores' key after proc_pharmacy")
         await msg.answer("❌ Ошибка: Данные состояния потеряны. Начните заново с /start.")
         await state.clear()
         return
     await msg.answer("Начинаем проверку…")
     await state.set_state(Form.rating)
-    logger.debug(f"Calling send_question for chat {msg.chat.id}")
+    logger.debug("Calling send_question for chat %s", msg.chat.id)
     await send_question(msg.chat.id, state)
 
 # === Отправка вопроса ===
-async def send_question(chat_id: int, state: FSMContext):
-    logger.info(f"Sending question to chat {chat_id}")
-    data = await state.get_data()
-    step = data.get("step", 0)
-    total = len(criteria)
-    logger.debug(f"Step: {step}, Total: {total}")
+async def session_expired(chat_id: int, state: FSMContext, data: dict):
+    """Версия чек-листа сессии недоступна — просим начать заново."""
+    logger.warning("Unknown checklist version %s for chat %s, current %s", data.get('version'), chat_id, checklists.current.version)
+    await bot.send_message(chat_id, "⚠️ Чек-лист был обновлён. Пожалуйста, начните проверку заново с /start.")
+    await state.clear()
+
+async def show_message(chat_id: int, text: str, message_id: int = None, reply_markup=None):
+    """В режиме одного сообщения редактирует message_id, иначе (или если правка не удалась) отправляет новое."""
+    if SINGLE_MESSAGE_MODE and message_id is not None:
+        try:
+            return await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+        except Exception as e:
+            logger.warning("Error editing message %s in chat %s, sending a new one: %s", message_id, chat_id, e)
+    return await bot.send_message(chat_id, text, reply_markup=reply_markup)
+
+@HANDLER_LATENCY.timed(handler="send_question")
+async def send_question(chat_id: int, state: FSMContext, message_id: int = None, step: int = None,
+                        checklist: Checklist = None):
+    logger.info("Sending question to chat %s", chat_id)
+    if step is None or checklist is None:
+        data = await state.get_data()
+        step = len(data.get("scores", []))
+        checklist = await checklists.resolve(data.get("version"))
+        if checklist is None:
+            await session_expired(chat_id, state, data)
+            return
+    total = len(checklist)
+    logger.debug("Step: %s, Total: %s", step, total)
 
     if total == 0:
         logger.error("Criteria list is empty")
@@ -208,104 +1672,77 @@ async def send_question(chat_id: int, state: FSMContext):
         return
 
     if step >= total:
-        logger.info(f"All criteria processed for chat {chat_id}")
-        await bot.send_message(
+        logger.info("All criteria processed for chat %s", chat_id)
+        await show_message(
             chat_id,
             "✅ Все оценки поставлены!\n\n"
             "📝 Напишите ваши выводы по аптеке:",
-            parse_mode=ParseMode.HTML
+            message_id
         )
         await state.set_state(Form.comment)
         return
 
     try:
-        criterion = criteria[step]
-        logger.debug(f"Criterion at step {step}: {criterion}")
-        required_keys = ["block", "criterion", "requirement", "max"]
-        missing_keys = [key for key in required_keys if key not in criterion or criterion[key] is None or str(criterion[key]).strip() == ""]
-        if missing_keys:
-            logger.error(f"Missing or empty keys in criterion at step {step}: {missing_keys}")
-            await bot.send_message(chat_id, f"❌ Ошибка: Некорректные данные критерия на шаге {step + 1}.")
-            await state.clear()
-            return
-
-        text = (
-            f"<b>Вопрос {step + 1} из {total}</b>\n\n"
-            f"<b>Блок:</b> {criterion['block']}\n"
-            f"<b>Критерий:</b> {criterion['criterion']}\n"
-            f"<b>Требование:</b> {criterion['requirement']}\n"
-            f"<b>Макс. балл:</b> {criterion['max']}"
-        )
-        kb = InlineKeyboardBuilder()
-        start_score = 0 if criterion["max"] == 1 else 1
-        for i in range(start_score, criterion["max"] + 1):
-            kb.button(text=str(i), callback_data=f"score_{i}")
-        if step > 0:
-            kb.button(text="◀️ Назад", callback_data="prev")
-        kb.adjust(5)
-
-        sent_message = await bot.send_message(chat_id, text, reply_markup=kb.as_markup())
-        logger.debug(f"Sent question {step + 1} to chat {chat_id}, message_id: {sent_message.message_id}")
+        text, markup = checklist.questions[step]
+        sent_message = await show_message(chat_id, text, message_id, markup)
+        logger.debug("Sent question %s to chat %s, message_id: %s", step + 1, chat_id, sent_message.message_id)
     except Exception as e:
-        logger.error(f"Error in send_question for chat {chat_id}: {e}", exc_info=True)
+        logger.error("Error in send_question for chat %s: %s", chat_id, e, exc_info=True)
         await bot.send_message(chat_id, "❌ Ошибка при отправке вопроса. Пожалуйста, начните заново с /start.")
         await state.clear()
 
 # === Обработка callback-запросов ===
+@HANDLER_LATENCY.timed(handler="cb_all")
 async def cb_all(cb: types.CallbackQuery, state: FSMContext):
-    logger.info(f"Callback from user {cb.from_user.id}: {cb.data}")
+    logger.info("Callback from user %s: %s", cb.from_user.id, cb.data)
     await cb.answer()
 
     data = await state.get_data()
-    logger.debug(f"FSM state data: {data}")
+    if dumps.allow():
+        logger.debug("FSM state data: %s", snapshot(data))
 
-    if not data or "step" not in data:
-        logger.error("FSM state is empty or missing 'step' key")
+    scores = data.get("scores")
+    if not isinstance(scores, list):
+        logger.error("FSM state is empty or missing 'scores' key")
         await bot.send_message(cb.message.chat.id, "❌ Ошибка: Состояние сброшено. Пожалуйста, начните заново с /start.")
         await state.clear()
         return
 
-    step = data.get("step", 0)
-    total = len(criteria)
-    logger.debug(f"Step: {step}, Total: {total}, Data: {cb.data}")
+    checklist = await checklists.resolve(data.get("version"))
+    if checklist is None:
+        await session_expired(cb.message.chat.id, state, data)
+        return
+
+    step = len(scores)
+    total = len(checklist)
+    logger.debug("Step: %s, Total: %s, Data: %s", step, total, cb.data)
+
+    # callback_data: score_<шаг>_<балл> или prev_<шаг>
+    parts = (cb.data or "").split("_")
+    action = parts[0]
+    if action in ("score", "prev"):
+        cb_step = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+        if cb_step != step:
+            # Повторное нажатие или кнопка уже отвеченного вопроса: состояние не трогаем
+            logger.info("Stale callback %s dropped, current step: %s", cb.data, step)
+            return
 
     if step >= total:
         logger.debug("All criteria rated")
         return
 
-    if cb.data.startswith("score_"):
+    if action == "score":
         try:
-            score = int(cb.data.split("_")[1])
-            criterion = criteria[step]
+            score = int(parts[2])
+            criterion = checklist.criteria[step]
             if score <= criterion["max"]:
-                # Проверяем наличие ключа 'data'
-                if "data" not in data or not isinstance(data["data"], list):
-                    logger.warning(f"'data' key missing or invalid in FSM state, initializing as empty list")
-                    # На шаге 0 это допустимо, так как список всё равно пустой
-                    if step == 0:
-                        data["data"] = []
-                    else:
-                        # На остальных шагах это критично
-                        await bot.send_message(
-                            cb.message.chat.id,
-                            "⚠️ Ошибка: Данные были потеряны. Пожалуйста, начните проверку заново с /start."
-                        )
-                        await state.clear()
-                        return
-                data["data"].append({"crit": criterion, "score": score})
-                data["step"] = step + 1
-                await state.update_data(**data)
-                logger.debug(f"Score {score} saved for step {step}")
-                logger.debug(f"Total scores saved: {len(data['data'])}")
-                # Проверяем, что количество сохранённых оценок соответствует текущему шагу
-                expected_scores = step + 1
-                if len(data["data"]) != expected_scores:
-                    logger.error(f"Data inconsistency: expected {expected_scores} scores, but found {len(data['data'])}")
-                    await bot.send_message(
-                        cb.message.chat.id,
-                        f"❌ Ошибка: Данные повреждены (ожидается {expected_scores} оценок, найдено {len(data['data'])}). Начните заново с /start."
-                    )
-                    await state.clear()
+                scores.append(score)
+                # Пишем только изменившийся ключ, а не всё состояние
+                await state.update_data(scores=scores)
+                logger.debug("Score %s saved for step %s", score, step)
+                if SINGLE_MESSAGE_MODE:
+                    # Следующий вопрос заменит текущий в том же сообщении
+                    await send_question(cb.message.chat.id, state, cb.message.message_id, step + 1, checklist)
                     return
                 try:
                     await bot.edit_message_text(
@@ -314,192 +1751,498 @@ async def cb_all(cb: types.CallbackQuery, state: FSMContext):
                         message_id=cb.message.message_id
                     )
                 except Exception as e:
-                    logger.error(f"Error editing message: {e}", exc_info=True)
-                await send_question(cb.message.chat.id, state)
+                    logger.error("Error editing message: %s", e, exc_info=True)
+                await send_question(cb.message.chat.id, state, step=step + 1, checklist=checklist)
             else:
-                logger.warning(f"Invalid score {score} for max {criterion['max']}")
+                logger.warning("Invalid score %s for max %s", score, criterion['max'])
                 await bot.send_message(cb.message.chat.id, "❌ Неверная оценка, попробуйте снова.")
-        except ValueError as e:
-            logger.error(f"Invalid callback data: {cb.data}, error: {e}")
+        except (IndexError, ValueError) as e:
+            logger.error("Invalid callback data: %s, error: %s", cb.data, e)
             await bot.send_message(cb.message.chat.id, "❌ Ошибка обработки оценки.")
-    elif cb.data == "prev" and step > 0:
-        if "data" not in data or not isinstance(data["data"], list):
-            logger.warning(f"'data' key missing or invalid in FSM state, initializing as empty list")
-            await bot.send_message(
-                cb.message.chat.id,
-                "⚠️ Ошибка: Данные были потеряны. Пожалуйста, начните проверку заново с /start."
-            )
-            await state.clear()
-            return
-        data["step"] = step - 1
-        data["data"].pop()
-        await state.update_data(**data)
-        logger.debug(f"Navigated back to step {step - 1}")
-        logger.debug(f"Total scores saved: {len(data['data'])}")
-        # Проверяем количество сохранённых оценок после возврата назад
-        expected_scores = step
-        if len(data["data"]) != expected_scores:
-            logger.error(f"Data inconsistency after prev: expected {expected_scores} scores, but found {len(data['data'])}")
-            await bot.send_message(
-                cb.message.chat.id,
-                f"❌ Ошибка: Данные повреждены (ожидается {expected_scores} оценок, найдено {len(data['data'])}). Начните заново с /start."
-            )
-            await state.clear()
-            return
-        await send_question(cb.message.chat.id, state)
+    elif action == "prev" and step > 0:
+        scores.pop()
+        await state.update_data(scores=scores)
+        logger.debug("Navigated back to step %s", step - 1)
+        await send_question(cb.message.chat.id, state, cb.message.message_id, step - 1, checklist)
     else:
-        logger.warning(f"Unhandled callback: {cb.data}")
+        logger.warning("Unhandled callback: %s", cb.data)
         await bot.send_message(cb.message.chat.id, "❌ Неизвестная команда.")
 
 # === Обработка комментария ===
+@HANDLER_LATENCY.timed(handler="proc_comment")
 async def proc_comment(msg: types.Message, state: FSMContext):
     comment = msg.text.strip()
-    logger.info(f"User {msg.from_user.id} entered comment: {comment}")
-    data = await state.get_data()
-    data["comment"] = comment
-    await state.update_data(**data)
-    logger.debug(f"Data before report generation: {data}")
-    if "data" not in data or not data["data"]:
+    logger.info("User %s entered comment: %s", msg.from_user.id, comment)
+    data = await state.update_data(comment=comment)
+    if dumps.allow():
+        logger.debug("Data before report generation: %s", snapshot(data))
+    if not data.get("scores"):
         logger.warning("No scores saved for the report")
         await msg.answer("⚠️ Ошибка: Оценки не сохранены. Пожалуйста, начните проверку заново с /start.")
         await state.clear()
         return
-    # Проверяем, что все 32 шага завершены
-    total_steps = len(criteria)
-    saved_scores = len(data["data"])
-    logger.info(f"Total scores saved before report: {saved_scores}")
+    checklist = await checklists.resolve(data.get("version"))
+    if checklist is None:
+        await session_expired(msg.chat.id, state, data)
+        return
+    # Проверяем, что все шаги завершены
+    total_steps = len(checklist)
+    saved_scores = len(data["scores"])
+    logger.info("Total scores saved before report: %s", saved_scores)
     if saved_scores != total_steps:
-        logger.error(f"Expected {total_steps} scores, but found {saved_scores}")
+        logger.error("Expected %s scores, but found %s", total_steps, saved_scores)
         await msg.answer(
             f"❌ Ошибка: Завершено только {saved_scores} из {total_steps} шагов. Начните проверку заново с /start."
         )
         await state.clear()
         return
     await msg.answer("⌛ Формирую отчёт…")
-    await make_report(msg.chat.id, data)
+    await make_report(msg.chat.id, data, checklist)
     await state.clear()
 
+# === Доставка отчётов (outbox) ===
+class ReportOutbox:
+    """Готовые отчёты сначала сохраняются в SQLite, затем фоновая задача отправляет их в Telegram.
+
+    Сбой Telegram не теряет отчёт и не держит обработчик: доставка повторяется с экспоненциальной
+    задержкой и джиттером, не более workers отправок одновременно. Получатели одного отчёта
+    обрабатываются по порядку, и после первой загрузки остальным уходит уже готовый file_id.
+    """
+
+    POLL_INTERVAL = 30.0
+    PRUNE_INTERVAL = 24 * 3600
+
+    def __init__(self, store: AuditStore, workers: int, max_attempts: int, base_delay: float, max_delay: float,
+                 retention_days: float = 0):
+        self.store = store
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retention_days = retention_days
+        self._pruned_at = 0.0
+        self._slots = asyncio.Semaphore(max(1, workers))
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._busy = False
+        self._stopping = False
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+
+    def stats(self) -> dict:
+        return {"delivered": self.delivered, "retried": self.retried, "failed": self.failed}
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._run(), name="report-outbox")
+
+    async def enqueue(self, report_key: str, user_id: int, file_name: str, content: bytes,
+                      deliveries: list) -> int:
+        """deliveries — словари с chat_id и необязательными caption и notice (текст после доставки)."""
+        now = time.time()
+        rows = [
+            (f"{report_key}:{d['chat_id']}", report_key, user_id, d["chat_id"], file_name, content,
+             d.get("caption"), d.get("notice"), now, now)
+            for d in deliveries
+        ]
+        added = await self.store.enqueue_reports(rows)
+        self.start()
+        self._wakeup.set()
+        return added
+
+    async def _prune(self):
+        # Раз в сутки (и при старте) чистим историю доставок старше retention_days; 0 — хранить всё
+        if self.retention_days <= 0 or time.time() - self._pruned_at < self.PRUNE_INTERVAL:
+            return
+        self._pruned_at = time.time()
+        removed = await self.store.prune_reports(self._pruned_at - self.retention_days * 86400)
+        if removed:
+            logger.info("Report outbox: %s old deliveries pruned", removed)
+
+    async def _run(self):
+        while not self._stopping:
+            # Сбрасываем до запроса: пробуждение во время запроса не потеряется
+            self._wakeup.clear()
+            try:
+                await self._prune()
+                rows = await self.store.due_reports(time.time())
+                if rows:
+                    groups = {}
+                    for row in rows:
+                        groups.setdefault(row["report_key"], []).append(row)
+                    self._busy = True
+                    try:
+                        # Ошибка одной группы не должна бросать остальные недождавшимися:
+                        # иначе следующий опрос заберёт строки, которые ещё отправляются
+                        results = await asyncio.gather(*(self._deliver_group(group) for group in groups.values()),
+                                                       return_exceptions=True)
+                    finally:
+                        self._busy = False
+                    for key, result in zip(groups, results):
+                        if isinstance(result, Exception):
+                            logger.error("Report outbox error on report %s: %s", key, result, exc_info=result)
+                    continue
+                due = await self.store.next_report_due()
+            except Exception as e:
+                logger.error("Report outbox error: %s", e, exc_info=True)
+                due = None
+            timeout = self.POLL_INTERVAL if due is None else min(self.POLL_INTERVAL, max(0.0, due - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver_group(self, rows: list):
+        file_id = None
+        for row in rows:
+            if file_id and not row["file_id"]:
+                row["file_id"] = file_id
+            async with self._slots:
+                file_id = await self._deliver(row) or file_id
+
+    async def _deliver(self, row: dict):
+        document = row["file_id"] or BufferedInputFile(row["content"], filename=row["file_name"])
+        try:
+            sent = await bot.send_document(row["chat_id"], document, caption=row["caption"])
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Повтор не поможет: бот заблокирован, чат не найден и т. п.
+            await self._give_up(row, e)
+            return None
+        except Exception as e:
+            attempts = row["attempts"] + 1
+            if attempts >= self.max_attempts:
+                await self._give_up(row, e)
+                return None
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+            if isinstance(e, TelegramRetryAfter):
+                delay = max(delay, e.retry_after)
+            self.retried += 1
+            logger.warning("Report %s to chat %s failed (attempt %s), retry in %.1fs: %s",
+                           row["report_key"], row["chat_id"], attempts, delay, e)
+            await self.store.mark_report_retry(row["id"], time.time() + delay, str(e))
+            return None
+        file_id = sent.document.file_id
+        await self.store.mark_report_sent(row["id"], row["report_key"], file_id)
+        self.delivered += 1
+        logger.info("Report %s delivered to chat %s", row["report_key"], row["chat_id"])
+        if row["notice"]:
+            try:
+                await bot.send_message(row["chat_id"], row["notice"])
+            except Exception as e:
+                logger.warning("Error sending delivery notice to chat %s: %s", row["chat_id"], e)
+        return file_id
+
+    async def _give_up(self, row: dict, error: Exception):
+        self.failed += 1
+        logger.error("Report %s to chat %s dropped after %s attempts: %s",
+                     row["report_key"], row["chat_id"], row["attempts"] + 1, error)
+        await self.store.mark_report_failed(row["id"], str(error))
+        user_id = row["user_id"]
+        if user_id and user_id != row["chat_id"]:
+            text = f"⚠️ Не удалось отправить отчёт в дополнительный чат {row['chat_id']}."
+        else:
+            text = "❌ Ошибка при отправке отчёта."
+        try:
+            await bot.send_message(user_id or row["chat_id"], text)
+        except Exception as e:
+            logger.warning("Error notifying user %s about failed delivery: %s", user_id, e)
+
+    async def drain(self, timeout: float) -> bool:
+        """Ждёт до timeout секунд, пока не будут отправлены все отчёты, срок которых уже наступил.
+
+        Отложенные повторы остаются в outbox и уйдут после перезапуска.
+        """
+        deadline = time.monotonic() + timeout
+        self.start()
+        self._wakeup.set()
+        while True:
+            if not self._busy and not await self.store.due_reports(time.time(), 1):
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+
+    async def close(self, timeout: float = None):
+        """Останавливает фоновую задачу после текущей пачки; по истечении timeout прерывает отправку.
+
+        Только на cancel() полагаться нельзя: в Python 3.11 asyncio.wait_for теряет отмену,
+        пришедшую одновременно с пробуждением, и задача снова засыпает на POLL_INTERVAL.
+        """
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        done, _ = await asyncio.wait({self._task}, timeout=timeout)
+        if not done:
+            logger.warning("Report outbox did not stop in %ss, cancelling delivery", timeout)
+            self._task.cancel()
+        self._task = None
+
+report_outbox = ReportOutbox(audit_store, OUTBOX_WORKERS, OUTBOX_MAX_ATTEMPTS, OUTBOX_BASE_DELAY, OUTBOX_MAX_DELAY,
+                             OUTBOX_RETENTION_DAYS)
+
 # === Генерация отчёта ===
-async def make_report(user_id: int, data):
+@HANDLER_LATENCY.timed(handler="make_report")
+async def make_report(user_id: int, data, checklist: Checklist):
     start_time = time.time()
-    logger.info(f"Generating report for user {user_id}")
-    logger.debug(f"Report data: {data}")
+    logger.info("Generating report for user %s", user_id)
+    if dumps.allow():
+        logger.debug("Report data: %s", snapshot(data))
     name = data["name"]
     ts = data["start"]
     pharmacy = data["pharmacy"]
     report_filename = f"{pharmacy}_{name}_{user_id}_{datetime.strptime(ts, '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y_%H%M')}.xlsx".replace(" ", "_")
 
     try:
-        wb = load_workbook(TEMPLATE_PATH)
-        ws = wb.active
-        title = f"Отчёт по проверке аптеки\nИсполнитель: {name}\nДата и время: {ts}"
-        ws.merge_cells("A1:G2")
-        ws["A1"] = title
-        ws["A1"].font = Font(size=14, bold=True)
-        ws["B3"] = pharmacy
-
-        headers = ["Блок", "Критерий", "Требование", "Оценка", "Макс", "Коммент.", "Дата проверки"]
-        for idx, header in enumerate(headers, start=1):
-            cell = ws.cell(5, idx, header)
-            cell.font = Font(bold=True)
-
-        row = 6
-        total_score = 0
-        total_max = 0
-        if "data" in data and data["data"]:
-            processed_count = 0
-            for rec in data["data"]:
-                crit = rec["crit"]
-                score = rec["score"]
-                ws.cell(row, 1, crit["block"])
-                ws.cell(row, 2, crit["criterion"])
-                ws.cell(row, 3, crit["requirement"])
-                ws.cell(row, 4, score)
-                ws.cell(row, 5, crit["max"])
-                ws.cell(row, 6, "")
-                ws.cell(row, 7, ts)
-                total_score += score
-                total_max += crit["max"]
-                row += 1
-                processed_count += 1
-            logger.info(f"Processed {processed_count} records in report")
+        rows = []
+        if data.get("scores"):
+            for crit, score in zip(checklist.criteria, data["scores"]):
+                rows.append((crit["block"], crit["criterion"], crit["requirement"], score, crit["max"]))
+            logger.info("Processed %s records in report", len(rows))
         else:
             logger.warning("No data available for report, table will be empty")
             await bot.send_message(user_id, "⚠️ Внимание: Отчёт пуст, так как оценки не были сохранены.")
 
-        ws.cell(row + 1, 3, "ИТОГО:")
-        ws.cell(row + 1, 4, total_score)
-        ws.cell(row + 2, 3, "Максимум:")
-        ws.cell(row + 2, 4, total_max)
-        ws.cell(row + 4, 1, "Вывод проверяющего:")
-        ws.cell(row + 5, 1, data.get("comment", ""))
-
-        wb.save(report_filename)
-        logger.info(f"Report saved: {report_filename}")
+        report = {
+            "name": name,
+            "start": ts,
+            "pharmacy": pharmacy,
+            "comment": data.get("comment", ""),
+            "rows": rows,
+        }
+        content, total_score, total_max = await report_pool.run(render_report, TEMPLATE_PATH, report)
+        logger.info("Report built: %s (%s bytes)", report_filename, len(content))
+        REPORT_SIZE.observe(len(content))
 
         try:
-            file = FSInputFile(report_filename, filename=report_filename)
-            # Отправка отчёта пользователю
-            await bot.send_document(user_id, file)
-            logger.info(f"Report sent to user {user_id}")
-            # Отправка отчёта в дополнительный чат, если CHAT_ID задан
-            if CHAT_ID != 0:
-                try:
-                    await bot.send_document(CHAT_ID, file, caption=f"Отчёт от {name} для аптеки {pharmacy}")
-                    logger.info(f"Report sent to additional chat {CHAT_ID}")
-                except Exception as e:
-                    logger.error(f"Error sending report to additional chat {CHAT_ID}: {e}", exc_info=True)
-                    await bot.send_message(user_id, f"⚠️ Не удалось отправить отчёт в дополнительный чат {CHAT_ID}.")
+            audit_id = await audit_store.save_audit({
+                "pharmacy": pharmacy,
+                "auditor": name,
+                "user_id": user_id,
+                "started_at": ts,
+                "checklist_version": checklist.version,
+                "total_score": total_score,
+                "total_max": total_max,
+                "comment": report["comment"],
+            }, rows)
+            logger.info("Audit %s saved to %s", audit_id, AUDIT_DB_PATH)
         except Exception as e:
-            logger.error(f"Error sending report to user {user_id}: {e}", exc_info=True)
-            await bot.send_message(user_id, "❌ Ошибка при отправке отчёта.")
-            return
+            logger.error("Error saving audit to database: %s", e, exc_info=True)
+
+        audit_log.write(pharmacy, name, ts, total_score, total_max)
 
-        await log_csv(pharmacy, name, ts, total_score, total_max)
-        await bot.send_message(user_id, "✅ Отчёт сформирован и отправлен.\n/start — новая проверка")
+        # Отправку берёт на себя outbox: отчёт сохранён и будет доставлен даже при сбоях Telegram
+        deliveries = [{"chat_id": user_id, "notice": "✅ Отчёт сформирован и отправлен.\n/start — новая проверка"}]
+        # Отправка отчёта в дополнительный чат, если CHAT_ID задан
+        if CHAT_ID != 0:
+            deliveries.append({"chat_id": CHAT_ID, "caption": f"Отчёт от {name} для аптеки {pharmacy}"})
+        report_key = f"{user_id}:{ts}"
+        added = await report_outbox.enqueue(report_key, user_id, report_filename, content, deliveries)
+        logger.info("Report %s queued for delivery (%s new deliveries)", report_key, added)
 
     except Exception as e:
-        logger.error(f"Error generating report: {e}", exc_info=True)
+        logger.error("Error generating report: %s", e, exc_info=True)
         await bot.send_message(user_id, "❌ Ошибка при формировании отчёта.")
     finally:
         elapsed_time = time.time() - start_time
-        logger.info(f"Report generation took {elapsed_time:.2f} seconds")
+        logger.info("Report generation took %.2f seconds", elapsed_time)
+
+# === Очередь входящих обновлений ===
+class UpdateQueue:
+    """Ограниченная очередь обновлений вебхука и пул воркеров, которые передают их в диспетчер.
+
+    Перед воркерами у каждого чата своя полоса: в общей очереди и в обработке одновременно
+    не больше одного обновления чата, остальные ждут в его полосе. Всплеск из одного чата
+    не занимает воркеры ожиданием замка, и другие чаты обрабатываются параллельно.
+    """
+
+    def __init__(self, workers: int, maxsize: int, dedupe_window: int):
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self._queue = asyncio.Queue()
+        # Ключ чата -> обновления, ждущие, пока текущее обновление этого чата обработается
+        self._lanes = {}
+        self._pending = 0
+        # Окно последних update_id: повторные доставки Telegram отбрасываются
+        self._seen = collections.deque(maxlen=dedupe_window)
+        self._seen_ids = set()
+        self._tasks = []
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.closed = False
+
+    def depth(self) -> int:
+        return self._pending
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "processed": self.processed,
+            "failed": self.failed,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "chats": len(self._lanes),
+        }
+
+    @staticmethod
+    def _lane_key(update: Update):
+        """(чат, пользователь) обновления, как у ключа FSM; None — обновление без чата и отправителя."""
         try:
-            if os.path.exists(report_filename):
-                os.remove(report_filename)
-                logger.info(f"Deleted report file: {report_filename}")
-        except Exception as e:
-            logger.warning(f"Failed to delete report file: {e}")
+            event = update.event
+        except Exception:
+            return None
+        chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+        user = getattr(event, "from_user", None)
+        if chat is None and user is None:
+            return None
+        return (chat.id if chat else None, user.id if user else None)
+
+    def _remember(self, update_id: int):
+        if len(self._seen) == self._seen.maxlen:
+            self._seen_ids.discard(self._seen[0])
+        self._seen.append(update_id)
+        self._seen_ids.add(update_id)
+
+    def submit(self, update: Update) -> bool:
+        """Кладёт обновление в очередь. False — очередь переполнена или закрыта, Telegram должен повторить позже."""
+        if self.closed:
+            return False
+        if update.update_id in self._seen_ids:
+            self.duplicates += 1
+            logger.info("Duplicate update %s dropped", update.update_id)
+            return True
+        if 0 < self.maxsize <= self._pending:
+            self.rejected += 1
+            logger.warning("Update queue is full (%s), update %s rejected", self.depth(), update.update_id)
+            return False
+        self._pending += 1
+        key = self._lane_key(update)
+        lane = self._lanes.get(key)
+        if lane is not None:
+            # Обновление этого чата уже в очереди или в обработке — ждём своей очереди в полосе
+            lane.append(update)
+        else:
+            if key is not None:
+                self._lanes[key] = collections.deque()
+            self._queue.put_nowait((key, update))
+        self._remember(update.update_id)
+        return True
+
+    def close(self):
+        """Перестаёт принимать обновления; уже принятые воркеры дообрабатывают."""
+        self.closed = True
+
+    async def join(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._queue.join(), max(0.0, timeout))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def start(self, dispatcher: Dispatcher, bot: Bot):
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(dispatcher, bot), name=f"update-worker-{i}"))
+        logger.info("Update queue started with %s workers", self.workers)
+
+    async def _worker(self, dispatcher: Dispatcher, bot: Bot):
+        while True:
+            key, update = await self._queue.get()
+            try:
+                await dispatcher.feed_update(bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error("Error processing update %s: %s", update.update_id, e, exc_info=True)
+            finally:
+                self._pending -= 1
+                self._advance(key)
+                self._queue.task_done()
+
+    def _advance(self, key):
+        # Следующее обновление чата попадает в общую очередь до task_done() текущего, поэтому join() его дождётся
+        lane = self._lanes.get(key)
+        if lane is None:
+            return
+        if lane:
+            self._queue.put_nowait((key, lane.popleft()))
+        else:
+            del self._lanes[key]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+update_queue = UpdateQueue(UPDATE_WORKERS, UPDATE_QUEUE_SIZE, UPDATE_DEDUPE_WINDOW)
 
 # === Webhook ===
 async def handle_webhook(request: web.Request):
-    logger.info(f"Webhook received: {request.method} {request.url}")
-    logger.debug(f"Request headers: {request.headers}")
+    logger.info("Webhook received: %s %s", request.method, request.url)
+    if update_queue.closed:
+        # Идёт остановка: Telegram повторит доставку, и её примет новый экземпляр
+        return web.Response(status=503, headers={"Retry-After": "1"})
+    if dumps.allow():
+        logger.debug("Request headers: %s", request.headers)
     try:
         update = await request.json()
-        logger.debug(f"Webhook data: {json.dumps(update, indent=2, ensure_ascii=False)}")
+        if dumps.allow():
+            logger.debug("Webhook data: %s", update)
         update_obj = Update(**update)
-        await dp.feed_update(bot, update_obj)
-        logger.info("Webhook update processed successfully")
-        return web.Response(text="OK")
     except Exception as e:
-        logger.error(f"Webhook error: {e}", exc_info=True)
-        return web.Response(status=500)
+        logger.error("Invalid webhook payload: %s", e)
+        return web.Response(status=400)
+    # Отвечаем сразу: обработка идёт в воркерах очереди
+    if not update_queue.submit(update_obj):
+        return web.Response(status=503, headers={"Retry-After": "1"})
+    logger.info("Webhook update %s queued, queue depth: %s", update_obj.update_id, update_queue.depth())
+    return web.Response(text="OK")
+
+# === Метрики: эндпоинт ===
+async def count_sessions(storage: BaseStorage) -> int:
+    """Число чатов с активным состоянием FSM (в Redis — обход ключей состояния через SCAN)."""
+    if isinstance(storage, RedisStorage):
+        pattern = f"{storage.key_builder.prefix}{storage.key_builder.separator}*{storage.key_builder.separator}state"
+        count = 0
+        async for _ in storage.redis.scan_iter(match=pattern, count=1000):
+            count += 1
+        return count
+    if isinstance(storage, MemoryStorage):
+        return sum(1 for record in storage.storage.values() if record.state is not None)
+    return 0
+
+async def handle_metrics(request: web.Request):
+    WEBHOOK_QUEUE_DEPTH.set(update_queue.depth())
+    REPORT_JOBS.set(report_pool.queued, state="queued")
+    REPORT_JOBS.set(report_pool.running, state="running")
+    try:
+        FSM_SESSIONS.set(await count_sessions(storage))
+    except Exception as e:
+        logger.error("Error counting FSM sessions: %s", e)
+    return web.Response(body=metrics.render().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
 
 async def on_startup(bot: Bot):
     if WEBHOOK_URL:
         webhook_path = "/webhook"
         webhook_url = f"{WEBHOOK_URL}{webhook_path}"
-        logger.info(f"Attempting to set webhook to: {webhook_url}")
+        logger.info("Attempting to set webhook to: %s", webhook_url)
         try:
             current_webhook = await bot.get_webhook_info()
-            logger.debug(f"Current webhook info: {current_webhook}")
-            await bot.set_webhook(webhook_url)
-            logger.info(f"Webhook successfully set to: {webhook_url}")
-            updated_webhook = await bot.get_webhook_info()
-            logger.debug(f"Updated webhook info: {updated_webhook}")
+            logger.debug("Current webhook info: %s", current_webhook)
+            # Несколько экземпляров делят один вебхук: повторная установка не нужна
+            if current_webhook.url == webhook_url:
+                logger.info("Webhook already set to: %s", webhook_url)
+            else:
+                await bot.set_webhook(webhook_url)
+                logger.info("Webhook successfully set to: %s", webhook_url)
+                updated_webhook = await bot.get_webhook_info()
+                logger.debug("Updated webhook info: %s", updated_webhook)
         except Exception as e:
-            logger.error(f"Error setting webhook: {e}", exc_info=True)
+            logger.error("Error setting webhook: %s", e, exc_info=True)
             logger.warning("Falling back to long polling due to webhook failure")
             return False
     else:
@@ -507,38 +2250,146 @@ async def on_startup(bot: Bot):
         return False
     return True
 
-async def on_shutdown(bot: Bot):
+async def _shutdown_step(name: str, aw, deadline: float):
+    """Шаг остановки не дольше, чем осталось до deadline. Зависший шаг бросается без ожидания
+    отмены (asyncio.wait, а не wait_for), ошибка шага не мешает остальным."""
+    task = asyncio.ensure_future(aw)
+    done, _ = await asyncio.wait({task}, timeout=max(0.0, deadline - time.monotonic()))
+    if not done:
+        task.cancel()
+        logger.warning("Shutdown step %s timed out", name)
+    elif task.exception() is not None:
+        logger.error("Shutdown step %s failed: %s", name, task.exception(), exc_info=task.exception())
+
+async def on_shutdown(bot: Bot, deadline: float = None):
+    """Дожидается обработчиков и доставки отчётов, затем сбрасывает всё на диск — в сумме до SHUTDOWN_TIMEOUT."""
     logger.info("Shutting down bot")
-    await bot.delete_webhook()
-    await bot.session.close()
+    if deadline is None:
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    # Ожидание не съедает всё время: последняя пятая часть остаётся на запись на диск
+    wait_deadline = deadline - (deadline - time.monotonic()) / 5
+    update_queue.close()
+    if not await update_queue.join(wait_deadline - time.monotonic()):
+        logger.warning("%s updates left in the queue at shutdown", update_queue.depth())
+    await update_queue.stop()
+    if not await in_flight.wait_idle(wait_deadline - time.monotonic()):
+        logger.warning("%s updates still in progress at shutdown", in_flight.count)
+    if not await report_outbox.drain(wait_deadline - time.monotonic()):
+        logger.warning("Undelivered reports left in the outbox, they will be sent after restart")
+    # Вебхук удаляем только по явной настройке: при деплое его уже использует новый экземпляр
+    if DELETE_WEBHOOK_ON_SHUTDOWN:
+        await _shutdown_step("delete_webhook", bot.delete_webhook(), deadline)
+    # Недоставленное остаётся в outbox: текущая отправка прерывается, не трогая запас на запись
+    await report_outbox.close(max(0.0, wait_deadline - time.monotonic()))
+    await _shutdown_step("audit_log", audit_log.close(), deadline)
+    if isinstance(storage, CheckpointStorage):
+        await _shutdown_step("checkpoints", storage.flush(), deadline)
+    await _shutdown_step("audit_store", audit_store.close(), deadline)
+    # Обработчики уже дождались своих отчётов; зависший воркер не должен держать остановку
+    report_pool.shutdown(wait=False)
+    await _shutdown_step("bot_session", bot.session.close(), deadline)
+    logger.info("Bot stopped")
 
-async def main():
+# === Восстановление прерванных проверок ===
+async def restore_sessions():
+    """После перезапуска возвращает незавершённые проверки из контрольных точек и повторяет текущий вопрос."""
+    if not isinstance(storage, CheckpointStorage):
+        return
+    try:
+        keys = await storage.restore(SESSION_TTL)
+    except Exception as e:
+        logger.error("Error restoring sessions: %s", e, exc_info=True)
+        return
+    logger.info("Restored %s interrupted sessions", len(keys))
+    prompts = {
+        Form.name.state: "Введите ваше ФИО:",
+        Form.pharmacy.state: "Введите название аптеки:",
+    }
+    for key in keys:
+        state = FSMContext(storage=storage, key=key)
+        current = await state.get_state()
+        try:
+            await bot.send_message(key.chat_id, "♻️ Бот был перезапущен, продолжаем проверку с того же места.")
+            if current in prompts:
+                await bot.send_message(key.chat_id, prompts[current])
+            else:
+                await send_question(key.chat_id, state)
+        except Exception as e:
+            logger.error("Error resuming session for chat %s: %s", key.chat_id, e)
+
+def setup_dispatcher() -> Dispatcher:
+    """Регистрирует обработчики в диспетчере (один раз на процесс)."""
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
+    dp.update.outer_middleware(in_flight)
 
     dp.message.register(cmd_start, F.text == "/start")
     dp.message.register(cmd_id, F.text == "/id")
     dp.message.register(cmd_reset, F.text == "/сброс")
+    dp.message.register(cmd_reload, F.text == "/reload")
+    dp.message.register(cmd_export, F.text.startswith("/export"))
     dp.message.register(proc_name, Form.name)
     dp.message.register(proc_pharmacy, Form.pharmacy)
     dp.message.register(proc_comment, Form.comment)
     dp.callback_query.register(cb_all)
+    return dp
+
+def build_app() -> web.Application:
+    app = web.Application()
+    app.add_routes([web.post("/webhook", handle_webhook), web.get("/metrics", handle_metrics)])
+    return app
 
+async def main():
+    setup_dispatcher()
+
+    try:
+        # Прогреваем кэш до запуска пула: форкнутые воркеры унаследуют готовый прототип
+        get_template(TEMPLATE_PATH)
+    except Exception as e:
+        logger.error("Error preparing report template: %s", e, exc_info=True)
+    report_pool.start()
+
+    if CHECKLIST_RELOAD_INTERVAL > 0:
+        asyncio.create_task(checklists.watch(CHECKLIST_RELOAD_INTERVAL), name="checklist-watch")
+
+    await restore_sessions()
+    # Досылаем отчёты, не доставленные до перезапуска
+    report_outbox.start()
     use_webhook = await on_startup(bot)
 
     if use_webhook:
-        app = web.Application()
-        app.add_routes([web.post("/webhook", handle_webhook)])
-        runner = web.AppRunner(app)
+        update_queue.start(dp, bot)
+        runner = web.AppRunner(build_app())
         await runner.setup()
         site = web.TCPSite(runner, "0.0.0.0", PORT)
         await site.start()
-        logger.info(f"Webhook server started on port {PORT}")
-        while True:
-            await asyncio.sleep(3600)
+        logger.info("Webhook server started on port %s", PORT)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+        await stop.wait()
+        # Повторный сигнал завершает процесс сразу, не дожидаясь остановки
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            if loop.remove_signal_handler(sig):
+                signal.signal(sig, signal.SIG_DFL)
+
+        logger.info("Shutdown signal received, draining updates")
+        await on_shutdown(bot, time.monotonic() + SHUTDOWN_TIMEOUT)
+        await runner.cleanup()
     else:
         logger.info("Starting bot in long polling mode")
         await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if len(sys.argv) > 1 and sys.argv[1] == "export":
+        export_cli(sys.argv[2:])
+    else:
+        try:
+            asyncio.run(main())
+        finally:
+            stop_logging()
@@ -0,0 +1,80 @@
+"""Проверка изоляции чатов в очереди вебхука: всплеск из одного чата не должен задерживать другие.
+
+Из чата A ставится --burst обновлений подряд, затем одно обновление из чата B. Обработчик
+спит --handler секунд (как долгий ответ Bot API). Обновления одного чата идут строго по очереди,
+поэтому B должен обработаться примерно за одно время обработчика, а не ждать, пока воркеры
+разберут хвост чата A.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_chat_burst.py [--burst 40] [--handler 0.2] [--workers 16]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def message_update(update_id: int, chat_id: int) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}"},
+        "text": "ping",
+    }}
+
+async def run(args) -> int:
+    os.environ.setdefault("API_TOKEN", "123456:BENCHMARK")
+    os.environ.setdefault("CHECKLIST_PATH", os.path.join(ROOT, "checklist.xlsx"))
+    os.environ.setdefault("TEMPLATE_PATH", os.path.join(ROOT, "template.xlsx"))
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.chdir(tempfile.mkdtemp(prefix="bench_chat_burst_"))
+    import Bot_Sadykhan as bot_module
+    from aiogram import Dispatcher
+    from aiogram.types import Update
+
+    handled = {}
+    order = []
+    dp = Dispatcher(events_isolation=bot_module.ChatEventIsolation())
+
+    @dp.message()
+    async def slow_handler(message):
+        await asyncio.sleep(args.handler)
+        handled.setdefault(message.chat.id, []).append(time.perf_counter())
+        if message.chat.id == 1:
+            order.append(message.message_id)
+
+    queue = bot_module.UpdateQueue(args.workers, 0, 1000)
+    queue.start(dp, bot_module.bot)
+    started = time.perf_counter()
+    for i in range(args.burst):
+        queue.submit(Update(**message_update(i + 1, 1)))
+    queue.submit(Update(**message_update(args.burst + 1, 2)))
+    await queue.join(args.burst * args.handler * 2 + 5)
+    await queue.stop()
+
+    other = handled[2][0] - started
+    burst = handled[1][-1] - started
+    print(f"Всплеск: {args.burst} обновлений из чата A, обработчик {args.handler * 1000:.0f} ms, "
+          f"воркеров: {args.workers}")
+    print(f"Чат A обработан за {burst:.2f}s (не меньше {args.burst * args.handler:.2f}s по очереди)")
+    print(f"Чат B обработан через {other:.2f}s")
+    in_order = order == sorted(order)
+    print(f"Порядок обновлений чата A {'сохранён' if in_order else 'НАРУШЕН'}")
+    # Допуск на планирование: B не должен ждать больше пары обработчиков
+    return 0 if in_order and other < args.handler * 3 else 1
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--burst", type=int, default=40)
+    parser.add_argument("--handler", type=float, default=0.2, help="время обработчика, с")
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Нагрузочный тест: N проверяющих одновременно проходят полный чек-лист.
+
+Бот работает против локальной заглушки Bot API (benchmarks/fake_bot_api.py) через
+TELEGRAM_API_URL. Обновления идут либо в handle_webhook (HTTP POST в приложение бота),
+либо в очередь getUpdates заглушки, откуда их забирает long polling. Каждый шаг меряется
+от отправки обновления до ответа бота, который нужен проверяющему для следующего шага.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_load.py [--auditors 20] [--mode webhook|polling] [--latency 0.05]
+
+По умолчанию лимиты исходящих сообщений сняты, чтобы мерить сам бот; --real-limits
+оставляет боевые SEND_RATE_* (1 сообщение в секунду на чат).
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI
+
+STEPS = ["start", "name", "pharmacy", "score", "report"]
+
+def percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+def is_prompt(event) -> bool:
+    """Ответ бота, после которого проверяющий может действовать: вопрос с кнопками или запрос выводов."""
+    _, message = event
+    markup = message.get("reply_markup") or {}
+    return bool(markup.get("inline_keyboard")) or "выводы" in (message.get("text") or "")
+
+class Auditor:
+    def __init__(self, chat_id: int, api: FakeBotAPI, send, timeout: float):
+        self.chat_id = chat_id
+        self.user = {"id": chat_id, "is_bot": False, "first_name": f"Auditor {chat_id}"}
+        self.api = api
+        self.send = send
+        self.timeout = timeout
+        self.timings = {step: [] for step in STEPS}
+        self._message_ids = itertools.count(1)
+
+    async def expect(self, predicate):
+        outbox = self.api.outbox[self.chat_id]
+        deadline = time.monotonic() + self.timeout
+        while True:
+            event = await asyncio.wait_for(outbox.get(), max(0.0, deadline - time.monotonic()))
+            if predicate(event):
+                return event
+
+    async def step(self, name: str, update: dict, predicate):
+        started = time.perf_counter()
+        await self.send(update)
+        event = await self.expect(predicate)
+        self.timings[name].append(time.perf_counter() - started)
+        return event
+
+    def text_update(self, text: str) -> dict:
+        return {"message": {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.chat_id, "type": "private"},
+            "from": self.user,
+            "text": text,
+        }}
+
+    def callback_update(self, message: dict, data: str) -> dict:
+        return {"callback_query": {
+            "id": f"{self.chat_id}-{next(self._message_ids)}",
+            "from": self.user,
+            "chat_instance": str(self.chat_id),
+            "message": message,
+            "data": data,
+        }}
+
+    async def run(self):
+        await self.step("start", self.text_update("/start"), lambda e: e[0] == "sendMessage")
+        await self.step("name", self.text_update(f"Проверяющий {self.chat_id}"), lambda e: e[0] == "sendMessage")
+        event = await self.step("pharmacy", self.text_update(f"Аптека №{self.chat_id % 50}"), is_prompt)
+        while (event[1].get("reply_markup") or {}).get("inline_keyboard"):
+            message = event[1]
+            buttons = [b["callback_data"] for row in message["reply_markup"]["inline_keyboard"] for b in row
+                       if b.get("callback_data", "").startswith("score_")]
+            event = await self.step("score", self.callback_update(message, random.choice(buttons)), is_prompt)
+        await self.step("report", self.text_update("Замечаний нет"), lambda e: e[0] == "sendDocument")
+        await self.expect(lambda e: "Отчёт сформирован" in (e[1].get("text") or ""))
+
+async def run_load(args):
+    api = FakeBotAPI(args.latency, args.jitter, args.upload_latency)
+    api_runner = await api.start()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_load_")
+    os.chdir(work_dir)
+    os.environ.update({
+        "API_TOKEN": "123456:BENCHMARK",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{api.port}",
+        "CHECKLIST_PATH": os.path.join(ROOT, "checklist.xlsx"),
+        "TEMPLATE_PATH": os.path.join(ROOT, "template.xlsx"),
+        "LOG_LEVEL": args.log_level,
+        "SINGLE_MESSAGE_MODE": "1" if args.single_message else "0",
+    })
+    os.environ.pop("WEBHOOK_URL", None)
+    os.environ.pop("REDIS_URL", None)
+    if not args.real_limits:
+        os.environ.update({"SEND_RATE_GLOBAL": "100000", "SEND_RATE_CHAT": "100000",
+                           "SEND_RATE_GROUP": "100000", "SEND_BURST_CHAT": "100000"})
+    import Bot_Sadykhan as bot_module
+
+    bot_module.setup_dispatcher()
+    bot_module.get_template(bot_module.TEMPLATE_PATH)
+    dp, bot = bot_module.dp, bot_module.bot
+
+    if args.mode == "webhook":
+        bot_module.update_queue.start(dp, bot)
+        bot_runner = web.AppRunner(bot_module.build_app())
+        await bot_runner.setup()
+        await web.TCPSite(bot_runner, "127.0.0.1", 0).start()
+        webhook_url = f"http://127.0.0.1:{bot_runner.addresses[0][1]}/webhook"
+        client = aiohttp.ClientSession()
+
+        async def send(update):
+            update = dict(update, update_id=api.next_update_id())
+            while True:
+                async with client.post(webhook_url, json=update) as response:
+                    if response.status != 503:
+                        response.raise_for_status()
+                        return
+                await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+    else:
+        polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+
+        async def send(update):
+            api.push_update(update)
+
+    auditors = [Auditor(100000 + i, api, send, args.timeout) for i in range(args.auditors)]
+
+    async def delayed(auditor, delay):
+        await asyncio.sleep(delay)
+        await auditor.run()
+
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(delayed(a, args.ramp * i / max(1, args.auditors)) for i, a in enumerate(auditors)),
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - started
+    failures = [r for r in results if isinstance(r, BaseException)]
+
+    if args.mode == "webhook":
+        await client.close()
+        await bot_module.update_queue.stop()
+        await bot_runner.cleanup()
+        await bot_module.on_shutdown(bot)
+    else:
+        await dp.stop_polling()
+        await polling
+    await api_runner.cleanup()
+
+    timings = {step: [t for a in auditors for t in a.timings[step]] for step in STEPS}
+    updates = sum(len(samples) for samples in timings.values())
+    print(f"Режим: {args.mode}, проверяющих: {args.auditors}, задержка API: {args.latency * 1000:.0f} ms, "
+          f"лимиты: {'боевые' if args.real_limits else 'сняты'}")
+    print(f"Завершено проверок: {args.auditors - len(failures)}/{args.auditors} за {elapsed:.1f}s")
+    for failure in failures[:3]:
+        print(f"  ошибка: {failure!r}")
+    print(f"Пропускная способность: {updates / elapsed:.1f} обновлений/с, "
+          f"{(args.auditors - len(failures)) / elapsed * 60:.1f} проверок/мин")
+    print(f"{'шаг':<10} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for step in STEPS:
+        samples = timings[step]
+        if not samples:
+            continue
+        print(f"{step:<10} {len(samples):>6} {percentile(samples, 0.5) * 1000:9.1f} "
+              f"{percentile(samples, 0.95) * 1000:9.1f} {percentile(samples, 0.99) * 1000:9.1f} "
+              f"{max(samples) * 1000:9.1f}")
+    if timings["report"]:
+        print(f"Формирование отчёта (комментарий -> документ): среднее "
+              f"{statistics.mean(timings['report']) * 1000:.1f} ms")
+    print(f"Вызовы API: {dict(api.calls)}")
+    return 1 if failures else 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--auditors", type=int, default=20)
+    parser.add_argument("--mode", choices=["webhook", "polling"], default="webhook")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--upload-latency", type=float, default=0.1, help="доп. задержка sendDocument, с")
+    parser.add_argument("--ramp", type=float, default=1.0, help="проверяющие стартуют равномерно за это время, с")
+    parser.add_argument("--timeout", type=float, default=60.0, help="ожидание ответа бота на шаг, с")
+    parser.add_argument("--single-message", action="store_true")
+    parser.add_argument("--real-limits", action="store_true")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run_load(args)))
+
+if __name__ == "__main__":
+    main()
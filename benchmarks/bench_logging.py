@@ -0,0 +1,162 @@
+"""Бенчмарк накладных расходов логирования на одно обновление (нажатие кнопки через вебхук).
+
+Сравнивается прежняя схема (синхронные обработчики, f-строки, json.dumps апдейта с indent=2,
+полный дамп состояния FSM) и текущая (DeferredQueueHandler + QueueListener: сообщение собирается
+в потоке слушателя, дампы через DumpLimiter). Меряется время в вызывающем потоке, т. е. то, что платит event loop,
+и отдельно — время до полной записи очереди на диск.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_logging.py [--updates 2000] [--repeat 5]
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import statistics
+import sys
+import tempfile
+import time
+from logging.handlers import QueueListener, RotatingFileHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("API_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("CHECKLIST_PATH", os.path.join(ROOT, "checklist.xlsx"))
+os.environ.setdefault("TEMPLATE_PATH", os.path.join(ROOT, "template.xlsx"))
+
+UPDATE = {
+    "update_id": 900000001,
+    "callback_query": {
+        "id": "4382bfdwdsb323b2d9",
+        "from": {"id": 123456789, "is_bot": False, "first_name": "Иван", "last_name": "Иванов",
+                 "username": "ivanov", "language_code": "ru"},
+        "message": {
+            "message_id": 4242,
+            "from": {"id": 987654321, "is_bot": True, "first_name": "Checklist", "username": "checklist_bot"},
+            "chat": {"id": 123456789, "first_name": "Иван", "last_name": "Иванов", "type": "private"},
+            "date": 1760000000,
+            "text": "📋 Вопрос 12/32\n\nБлок: Помещение\nКритерий: Туалетная комната\n"
+                    "Требование: В туалетной комнате чисто, зеркало без пятен и разводов.\nМакс: 5",
+        },
+        "chat_instance": "-8123891275612312",
+        "data": "score_12_4",
+    },
+}
+STATE = {
+    "name": "Иванов Иван",
+    "pharmacy": "Аптека №12, ул. Абая 10",
+    "version": "bfd56f2517fa",
+    "start": "2026-10-17 10:00:00",
+    "scores": [3, 5, 3, 3, 3, 3, 1, 3, 5, 5, 5, 3],
+}
+HEADERS = {"Host": "bot.example.com", "Content-Type": "application/json", "Content-Length": "812",
+           "X-Telegram-Bot-Api-Secret-Token": "secret", "X-Forwarded-For": "149.154.167.220"}
+
+def legacy_update(logger):
+    """Вызовы логгера на одно нажатие кнопки в прежнем коде."""
+    logger.info(f"Webhook received: POST https://bot.example.com/webhook")
+    logger.debug(f"Request headers: {HEADERS}")
+    logger.debug(f"Webhook data: {json.dumps(UPDATE, indent=2, ensure_ascii=False)}")
+    logger.info(f"Webhook update {UPDATE['update_id']} queued, queue depth: 0")
+    logger.info(f"Callback from user 123456789: score_12_4")
+    logger.debug(f"FSM state data: {STATE}")
+    logger.debug(f"Step: 12, Total: 32, Data: score_12_4")
+    logger.debug(f"Score 4 saved for step 12")
+    logger.info(f"Sending question to chat 123456789")
+    logger.debug(f"Step: 13, Total: 32")
+    logger.debug(f"Sent question 14 to chat 123456789, message_id: 4243")
+
+def current_update(logger, dumps, snapshot):
+    """Те же вызовы в текущем коде."""
+    logger.info("Webhook received: %s %s", "POST", "https://bot.example.com/webhook")
+    if dumps.allow():
+        logger.debug("Request headers: %s", HEADERS)
+    if dumps.allow():
+        logger.debug("Webhook data: %s", UPDATE)
+    logger.info("Webhook update %s queued, queue depth: %s", UPDATE["update_id"], 0)
+    logger.info("Callback from user %s: %s", 123456789, "score_12_4")
+    if dumps.allow():
+        logger.debug("FSM state data: %s", snapshot(STATE))
+    logger.debug("Step: %s, Total: %s, Data: %s", 12, 32, "score_12_4")
+    logger.debug("Score %s saved for step %s", 4, 12)
+    logger.info("Sending question to chat %s", 123456789)
+    logger.debug("Step: %s, Total: %s", 13, 32)
+    logger.debug("Sent question %s to chat %s, message_id: %s", 14, 123456789, 4243)
+
+def make_handlers(directory: str, formatter: logging.Formatter) -> list:
+    console = logging.StreamHandler(open(os.path.join(directory, "console.log"), "a", encoding="utf-8"))
+    file = RotatingFileHandler(os.path.join(directory, "app.log"), maxBytes=5*1024*1024, backupCount=3,
+                               encoding="utf-8")
+    for handler in (console, file):
+        handler.setFormatter(formatter)
+    return [console, file]
+
+def run(logger, handlers, level, emit, updates: int, use_queue: bool, queue_handler):
+    """Возвращает (мкс на обновление в вызывающем потоке, мкс на обновление до записи на диск)."""
+    logger.handlers = []
+    logger.setLevel(level)
+    listener = None
+    if use_queue:
+        log_queue = queue.SimpleQueue()
+        logger.addHandler(queue_handler(log_queue))
+        listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+    started = time.perf_counter()
+    for _ in range(updates):
+        emit()
+    emitted = time.perf_counter()
+    if listener is not None:
+        listener.stop()
+    drained = time.perf_counter()
+    logger.handlers = []
+    return (emitted - started) / updates * 1e6, (drained - started) / updates * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_logging_")
+    os.chdir(work_dir)
+    import Bot_Sadykhan as bot_module
+    logger = bot_module.logger
+
+    scenarios = [
+        ("прежний: DEBUG, синхронно, f-строки", logging.DEBUG, False,
+         lambda: legacy_update(logger), None),
+        ("прежний: INFO, синхронно, f-строки", logging.INFO, False,
+         lambda: legacy_update(logger), None),
+        ("текущий: DEBUG, очередь, дампы без лимита", logging.DEBUG, True,
+         lambda: current_update(logger, limiter, bot_module.snapshot), (1.0, 10**9)),
+        ("текущий: DEBUG, очередь, LOG_DUMP_BUDGET=60", logging.DEBUG, True,
+         lambda: current_update(logger, limiter, bot_module.snapshot), (1.0, 60)),
+        ("текущий: INFO, очередь", logging.INFO, True,
+         lambda: current_update(logger, limiter, bot_module.snapshot), (1.0, 60)),
+    ]
+    rows = []
+    for name, level, use_queue, emit, limits in scenarios:
+        caller, total = [], []
+        for _ in range(args.repeat):
+            if limits is not None:
+                limiter = bot_module.DumpLimiter(*limits)
+            handlers = make_handlers(work_dir, bot_module.formatter)
+            c, t = run(logger, handlers, level, emit, args.updates, use_queue, bot_module.DeferredQueueHandler)
+            for handler in handlers:
+                handler.close()
+            caller.append(c)
+            total.append(t)
+        rows.append((name, statistics.median(caller), statistics.median(total)))
+
+    width = max(len(name) for name, _, _ in rows)
+    print(f"Медиана из {args.repeat} запусков по {args.updates} обновлений, мкс на обновление")
+    print(f"{'':<{width}}  {'event loop':>10}  {'до диска':>10}")
+    for name, caller, total in rows:
+        print(f"{name:<{width}}  {caller:10.1f}  {total:10.1f}")
+
+if __name__ == "__main__":
+    main()
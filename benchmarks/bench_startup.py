@@ -0,0 +1,107 @@
+"""Бенчмарк загрузки чек-листа при старте: pandas против openpyxl read_only и JSON-кэша.
+
+Импорт aiogram и openpyxl нужен боту при любом способе загрузки, поэтому сравнивается только
+то, что зависит от способа: импорт pandas (в отдельном интерпретаторе) и сам разбор.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_startup.py [--repeat 5]
+"""
+import argparse
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("API_TOKEN", "123456:BENCHMARK")
+CHECKLIST_PATH = os.environ.setdefault("CHECKLIST_PATH", os.path.join(ROOT, "checklist.xlsx"))
+os.environ.setdefault("TEMPLATE_PATH", os.path.join(ROOT, "template.xlsx"))
+
+def legacy_load(path: str) -> list:
+    """Прежняя загрузка критериев из Bot_Sadykhan.py."""
+    import pandas as pd
+    df = pd.read_excel(path, sheet_name="Чек лист", header=None)
+    start_i = df[df.iloc[:, 0] == "Блок"].index[0] + 1
+    df = df.iloc[start_i:, :8].reset_index(drop=True)
+    df.columns = ["Блок", "Критерий", "Требование", "Оценка", "Макс", "Примечание", "Дата проверки", "Дата исправления"]
+    criteria = []
+    last_block = "Неизвестный блок"
+    for _, row in df.iterrows():
+        if pd.isna(row["Критерий"]) or pd.isna(row["Требование"]):
+            continue
+        block = row["Блок"] if pd.notna(row["Блок"]) else last_block
+        last_block = block
+        max_value = str(row["Макс"])
+        criteria.append({
+            "block": block,
+            "criterion": str(row["Критерий"]),
+            "requirement": str(row["Требование"]),
+            "max": int(max_value) if max_value.isdigit() else 10
+        })
+    return criteria
+
+def import_time(module: str) -> float:
+    """Время импорта модуля в новом интерпретаторе, в секундах."""
+    code = f"import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return float(out.stdout.strip())
+
+def median_time(func, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    # Модуль бота при импорте создаёт app.log и .checklist_cache в текущем каталоге
+    os.chdir(tempfile.mkdtemp(prefix="bench_startup_"))
+    import Bot_Sadykhan as bot_module
+
+    cache_dir = tempfile.mkdtemp(prefix="checklist_cache_")
+    rows = []
+    legacy_total = None
+    try:
+        try:
+            pandas_import = statistics.median(import_time("pandas") for _ in range(args.repeat))
+            legacy_parse = median_time(lambda: legacy_load(CHECKLIST_PATH), args.repeat)
+            assert legacy_load(CHECKLIST_PATH) == bot_module.parse_checklist(CHECKLIST_PATH), "parsers disagree"
+            legacy_total = pandas_import + legacy_parse
+            rows.append(("import pandas (новый интерпретатор)", pandas_import))
+            rows.append(("pandas.read_excel + iterrows", legacy_parse))
+        except ImportError:
+            print("pandas не установлен — прежний способ пропущен")
+
+        parse = median_time(lambda: bot_module.parse_checklist(CHECKLIST_PATH), args.repeat)
+        rows.append(("parse_checklist (openpyxl read_only)", parse))
+
+        def cold():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            bot_module.load_criteria(CHECKLIST_PATH, cache_dir)
+        rows.append(("load_criteria, кэша нет (разбор + запись)", median_time(cold, args.repeat)))
+        cached = median_time(lambda: bot_module.load_criteria(CHECKLIST_PATH, cache_dir), args.repeat)
+        rows.append(("load_criteria, кэш готов", cached))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    width = max(len(name) for name, _ in rows)
+    print(f"Медиана из {args.repeat} запусков, {CHECKLIST_PATH}")
+    for name, seconds in rows:
+        print(f"{name:<{width}}  {seconds * 1000:9.1f} ms")
+    if legacy_total is not None:
+        print(f"Старт: было {legacy_total * 1000:.1f} ms, стало {cached * 1000:.1f} ms "
+              f"(x{legacy_total / cached:.0f} быстрее)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""Локальная заглушка Telegram Bot API для нагрузочных тестов.
+
+Понимает методы, которые вызывает бот: getMe, getUpdates, sendMessage, editMessageText,
+sendDocument, answerCallbackQuery, а также служебные get/set/deleteWebhook. Остальные
+методы отвечают true. Каждый ответ задерживается на latency ± jitter секунд.
+
+Бот подключается к заглушке через TELEGRAM_API_URL=http://127.0.0.1:<порт>.
+Отправленные ботом сообщения складываются в очередь чата (FakeBotAPI.outbox),
+а обновления для long polling кладутся через FakeBotAPI.push_update().
+
+Отдельный запуск:
+    python benchmarks/fake_bot_api.py [--port 8081] [--latency 0.05]
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+BOT_USER = {"id": 987654321, "is_bot": True, "first_name": "Checklist", "username": "checklist_bot"}
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, upload_latency: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.upload_latency = upload_latency
+        self.calls = collections.Counter()
+        self.outbox = collections.defaultdict(asyncio.Queue)
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+        self._message_ids = itertools.count(1000)
+        self._file_ids = itertools.count(1)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.add_routes([web.post("/bot{token}/{method}", self.handle)])
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        self.port = runner.addresses[0][1]
+        return runner
+
+    def push_update(self, update: dict) -> dict:
+        """Кладёт обновление в очередь getUpdates, проставляя update_id."""
+        update = dict(update, update_id=next(self._update_ids))
+        self._updates.append(update)
+        self._new_updates.set()
+        return update
+
+    def next_update_id(self) -> int:
+        return next(self._update_ids)
+
+    async def _delay(self, extra: float = 0.0):
+        delay = self.latency + extra + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _message(self, chat_id, message_id=None, **fields) -> dict:
+        message = {
+            "message_id": message_id or next(self._message_ids),
+            "from": BOT_USER,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+        }
+        message.update({k: v for k, v in fields.items() if v is not None})
+        return message
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = dict(await request.post())
+        handler = getattr(self, f"api_{method.lower()}", None)
+        result = await handler(params) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def api_getme(self, params):
+        return BOT_USER
+
+    async def api_getwebhookinfo(self, params):
+        return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+
+    async def api_getupdates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout > 0:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return self._updates[:limit]
+
+    async def api_sendmessage(self, params):
+        await self._delay()
+        chat_id = int(params["chat_id"])
+        markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+        message = self._message(chat_id, text=params.get("text"), reply_markup=markup)
+        self.outbox[chat_id].put_nowait(("sendMessage", message))
+        return message
+
+    async def api_editmessagetext(self, params):
+        await self._delay()
+        chat_id = int(params["chat_id"])
+        markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+        message = self._message(chat_id, int(params["message_id"]), text=params.get("text"), reply_markup=markup)
+        self.outbox[chat_id].put_nowait(("editMessageText", message))
+        return message
+
+    async def api_senddocument(self, params):
+        document = params.get("document")
+        if isinstance(document, str) and document.startswith("attach://"):
+            document = params.get(document[len("attach://"):])
+        size = 0
+        if isinstance(document, str):
+            await self._delay()
+            file_id = document
+        else:
+            size = len(document.file.read())
+            await self._delay(self.upload_latency)
+            file_id = f"fake-file-{next(self._file_ids)}"
+        chat_id = int(params["chat_id"])
+        message = self._message(chat_id, caption=params.get("caption"),
+                                document={"file_id": file_id, "file_unique_id": file_id, "file_size": size})
+        self.outbox[chat_id].put_nowait(("sendDocument", message))
+        return message
+
+    async def api_answercallbackquery(self, params):
+        await self._delay()
+        return True
+
+async def serve(port: int, latency: float, jitter: float):
+    api = FakeBotAPI(latency, jitter)
+    await api.start(port=port)
+    print(f"Fake Bot API on http://127.0.0.1:{api.port}")
+    while True:
+        await asyncio.sleep(3600)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.latency, args.jitter))